@@ -160,7 +160,7 @@ def AddSystem(output_zip, recovery_img=None, boot_img=None):
 
     if output_zip:
       arc_name = "SYSTEM/" + fn
-      if arc_name in output_zip.namelist():
+      if arc_name in common.GetZipEntryNames(output_zip):
         OPTIONS.replace_updated_files_list.append(arc_name)
       else:
         common.ZipWrite(output_zip, output_file, arc_name)
@@ -563,8 +563,8 @@ def CheckAbOtaImages(output_zip, ab_partitions):
       # Zip spec says: All slashes MUST be forward slashes.
       images_path = "IMAGES/" + img_name
       radio_path = "RADIO/" + img_name
-      available = (images_path in output_zip.namelist() or
-                   radio_path in output_zip.namelist())
+      entry_names = common.GetZipEntryNames(output_zip)
+      available = (images_path in entry_names or radio_path in entry_names)
     else:
       images_path = os.path.join(OPTIONS.input_tmp, "IMAGES", img_name)
       radio_path = os.path.join(OPTIONS.input_tmp, "RADIO", img_name)
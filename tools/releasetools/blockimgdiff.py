@@ -16,10 +16,12 @@ from __future__ import print_function
 
 import array
 import copy
+import errno
 import functools
 import heapq
 import itertools
 import logging
+import mmap
 import multiprocessing
 import os
 import os.path
@@ -40,6 +42,17 @@ logger = logging.getLogger(__name__)
 # The tuple contains the style and bytes of a bsdiff|imgdiff patch.
 PatchInfo = namedtuple("PatchInfo", ["imgdiff", "content"])
 
+# Runs of digits, which are replaced by "#" when matching up files whose
+# names only differ in version numbers.
+_DIGITS_RE = re.compile("[0-9]+")
+
+# The lseek() whence values that find the data and the holes of a sparse file.
+# Python 2's os module doesn't define them, but their values are fixed on Linux.
+if sys.platform.startswith("linux"):
+  _SEEK_DATA, _SEEK_HOLE = 3, 4
+else:
+  _SEEK_DATA = _SEEK_HOLE = None
+
 
 def compute_patch(srcfile, tgtfile, imgdiff=False):
   """Calls bsdiff|imgdiff to compute the patch data, returns a PatchInfo."""
@@ -195,6 +208,14 @@ class FileImage(Image):
     self._file_size = os.path.getsize(self.path)
     self._file = open(self.path, 'rb')
 
+    # Map the image, so that reading a block is a slice of the mapping rather
+    # than a seek() and read() on the file. Fall back to reading the file if it
+    # can't be mapped (e.g. it's empty).
+    try:
+      self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+      self._mmap = None
+
     if self._file_size % self.blocksize != 0:
       raise ValueError("Size of file %s must be multiple of %d bytes, but is %d"
                        % self.path, self.blocksize, self._file_size)
@@ -212,16 +233,40 @@ class FileImage(Image):
 
     zero_blocks = []
     nonzero_blocks = []
-    reference = '\0' * self.blocksize
-
-    for i in range(self.total_blocks):
-      d = self._file.read(self.blocksize)
-      if d == reference:
-        zero_blocks.append(i)
-        zero_blocks.append(i+1)
-      else:
-        nonzero_blocks.append(i)
-        nonzero_blocks.append(i+1)
+    reference = b'\0' * self.blocksize
+    # Compare 256 blocks at a time against zeros first; only a run that isn't
+    # entirely zero gets split into blocks.
+    chunk_blocks = 256
+    zero_chunk = b'\0' * (chunk_blocks * self.blocksize)
+
+    # Blocks that fall entirely into a hole of the file are known to be zero,
+    # so only the allocated extents need to be read.
+    self.data_extents = self._GetDataExtents()
+    next_block = 0
+    for start, end in self.data_extents:
+      if next_block < start:
+        zero_blocks.append(next_block)
+        zero_blocks.append(start)
+      for chunk_start in range(start, end, chunk_blocks):
+        chunk_end = min(chunk_start + chunk_blocks, end)
+        chunk = self._Read(chunk_start * self.blocksize,
+                           (chunk_end - chunk_start) * self.blocksize)
+        if chunk == zero_chunk[:len(chunk)]:
+          zero_blocks.append(chunk_start)
+          zero_blocks.append(chunk_end)
+          continue
+        for i in range(chunk_start, chunk_end):
+          offset = (i - chunk_start) * self.blocksize
+          if chunk[offset:offset + self.blocksize] == reference:
+            zero_blocks.append(i)
+            zero_blocks.append(i+1)
+          else:
+            nonzero_blocks.append(i)
+            nonzero_blocks.append(i+1)
+      next_block = end
+    if next_block < self.total_blocks:
+      zero_blocks.append(next_block)
+      zero_blocks.append(self.total_blocks)
 
     assert zero_blocks or nonzero_blocks
 
@@ -233,22 +278,85 @@ class FileImage(Image):
     if self.hashtree_info:
       self.file_map["__HASHTREE"] = self.hashtree_info.hashtree_range
 
+  def _GetDataExtents(self):
+    """Returns the RangeSet of blocks that have data allocated in the file.
+
+    Uses SEEK_DATA/SEEK_HOLE to skip over the holes of a sparse file. Blocks
+    partially covered by data count as allocated. Returns the whole care_map
+    if the platform or the filesystem doesn't support it.
+    """
+    if _SEEK_DATA is None or not self.total_blocks:
+      return self.care_map
+
+    extents = []
+    fd = os.open(self.path, os.O_RDONLY)
+    try:
+      offset = 0
+      while offset < self._file_size:
+        try:
+          data_start = os.lseek(fd, offset, _SEEK_DATA)
+        except OSError as e:
+          # ENXIO means there's no more data past offset.
+          if e.errno == errno.ENXIO:
+            break
+          return self.care_map
+        data_end = os.lseek(fd, data_start, _SEEK_HOLE)
+        start = data_start // self.blocksize
+        end = min(-(-data_end // self.blocksize), self.total_blocks)
+        if extents and start <= extents[-1]:
+          extents[-1] = max(extents[-1], end)
+        else:
+          extents.extend((start, end))
+        offset = data_end
+    except OSError:
+      return self.care_map
+    finally:
+      os.close(fd)
+    return RangeSet(data=extents)
+
   def __del__(self):
-    self._file.close()
+    # __init__() may have failed before opening the file.
+    if getattr(self, "_mmap", None) is not None:
+      self._mmap.close()
+    if getattr(self, "_file", None) is not None:
+      self._file.close()
+
+  def _Read(self, offset, length):
+    """Reads up to length bytes at the given offset."""
+    if self._mmap is not None:
+      return self._mmap[offset:offset + length]
+    self._file.seek(offset)
+    return self._file.read(length)
 
   def _GetRangeData(self, ranges):
     # Use a lock to protect the generator so that we will not run two
     # instances of this generator on the same object simultaneously.
     with self.generator_lock:
       for s, e in ranges:
+        if self._mmap is not None:
+          for i in range(s, e):
+            yield self._mmap[i * self.blocksize:(i + 1) * self.blocksize]
+          continue
         self._file.seek(s * self.blocksize)
         for _ in range(s, e):
           yield self._file.read(self.blocksize)
 
   def RangeSha1(self, ranges):
+    # Hash each contiguous range in large chunks rather than block by block,
+    # so that hashing a whole partition image doesn't take millions of small
+    # reads and update() calls.
     h = sha1()
-    for data in self._GetRangeData(ranges): # pylint: disable=not-an-iterable
-      h.update(data)
+    chunk_size = 256 * self.blocksize
+    with self.generator_lock:
+      for s, e in ranges:
+        offset = s * self.blocksize
+        end = e * self.blocksize
+        while offset < end:
+          data = self._Read(offset, min(end - offset, chunk_size))
+          if not data:
+            break
+          h.update(data)
+          offset += len(data)
     return h.hexdigest()
 
   def ReadRangeSet(self, ranges):
@@ -442,12 +550,15 @@ class BlockImageDiff(object):
   """
 
   def __init__(self, tgt, src=None, threads=None, version=4,
-               disable_imgdiff=False):
+               disable_imgdiff=False, pool=None):
     if threads is None:
       threads = multiprocessing.cpu_count() // 2
       if threads == 0:
         threads = 1
     self.threads = threads
+    # An optional multiprocessing.pool.ThreadPool to run the worker loops on,
+    # so that several BlockImageDiffs can share one set of threads.
+    self.pool = pool
     self.version = version
     self.transfers = []
     self.src_basenames = {}
@@ -1319,6 +1430,18 @@ class BlockImageDiff(object):
           b.goes_before[a] = size
           a.goes_after[b] = size
 
+  def _RunWorkers(self, worker):
+    """Runs self.threads instances of worker() and waits for all of them."""
+    if self.pool is not None:
+      self.pool.map(lambda _: worker(), range(self.threads))
+      return
+
+    threads = [threading.Thread(target=worker) for _ in range(self.threads)]
+    for th in threads:
+      th.start()
+    while threads:
+      threads.pop().join()
+
   def ComputePatchesForInputList(self, diff_queue, compress_target):
     """Returns a list of patch information for the input list of transfers.
 
@@ -1403,12 +1526,7 @@ class BlockImageDiff(object):
         with lock:
           patches[patch_index] = (xf_index, patch_info, compressed_size)
 
-    threads = [threading.Thread(target=diff_worker)
-               for _ in range(self.threads)]
-    for th in threads:
-      th.start()
-    while threads:
-      threads.pop().join()
+    self._RunWorkers(diff_worker)
 
     if error_messages:
       logger.error('ERROR:')
@@ -1797,7 +1915,7 @@ class BlockImageDiff(object):
                     "diff", self.transfers, True)
         continue
 
-      b = re.sub("[0-9]+", "#", b)
+      b = _DIGITS_RE.sub("#", b)
       if b in self.src_numpatterns:
         # Look for a 'number pattern' match (a basename match after
         # all runs of digits are replaced by "#").  (This is useful
@@ -1811,12 +1929,7 @@ class BlockImageDiff(object):
       AddTransfer(tgt_fn, None, tgt_ranges, empty, "new", self.transfers)
 
     transfer_lock = threading.Lock()
-    threads = [threading.Thread(target=SplitLargeApks)
-               for _ in range(self.threads)]
-    for th in threads:
-      th.start()
-    while threads:
-      threads.pop().join()
+    self._RunWorkers(SplitLargeApks)
 
     # Sort the split transfers for large apks to generate a determinate package.
     split_large_apks.sort()
@@ -1832,7 +1945,7 @@ class BlockImageDiff(object):
     for k in self.src.file_map.keys():
       b = os.path.basename(k)
       self.src_basenames[b] = k
-      b = re.sub("[0-9]+", "#", b)
+      b = _DIGITS_RE.sub("#", b)
       self.src_numpatterns[b] = k
 
   @staticmethod
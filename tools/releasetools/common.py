@@ -16,24 +16,32 @@ from __future__ import print_function
 
 import base64
 import collections
-import copy
+import contextlib
 import errno
 import fnmatch
 import getopt
 import getpass
 import gzip
 import imp
+import io
+import itertools
 import json
 import logging
 import logging.config
+import multiprocessing
+import multiprocessing.pool
 import os
 import platform
 import re
 import shlex
 import shutil
+import stat
+import string
+import struct
 import subprocess
 import sys
 import tempfile
+import termios
 import threading
 import time
 import zipfile
@@ -141,8 +149,9 @@ class ExternalError(RuntimeError):
   pass
 
 
-def InitLogging():
-  DEFAULT_LOGGING_CONFIG = {
+def _MakeLoggingConfig(level):
+  """Returns a fresh copy of the default logging config at the given level."""
+  return {
       'version': 1,
       'disable_existing_loggers': False,
       'formatters': {
@@ -161,24 +170,40 @@ def InitLogging():
       'loggers': {
           '': {
               'handlers': ['default'],
-              'level': 'WARNING',
+              'level': level,
               'propagate': True,
           }
       }
   }
+
+
+DEFAULT_LOGGING_CONFIG = _MakeLoggingConfig('WARNING')
+
+# Whether DEFAULT_LOGGING_CONFIG has been applied by InitLogging().
+_default_logging_applied = False
+
+
+def InitLogging():
+  global _default_logging_applied
+
   env_config = os.getenv('LOGGING_CONFIG')
   if env_config:
     with open(env_config) as f:
       config = json.load(f)
-  else:
-    config = DEFAULT_LOGGING_CONFIG
+    logging.config.dictConfig(config)
+    _default_logging_applied = False
+    return
 
-    # Increase the logging level for verbose mode.
-    if OPTIONS.verbose:
-      config = copy.deepcopy(DEFAULT_LOGGING_CONFIG)
-      config['loggers']['']['level'] = 'INFO'
+  # dictConfig() tears down and rebuilds all the handlers, which is wasted work
+  # if the default config is already in place. Only adjust the root level then.
+  if _default_logging_applied:
+    logging.getLogger().setLevel('INFO' if OPTIONS.verbose else 'WARNING')
+    return
 
+  # Increase the logging level for verbose mode.
+  config = _MakeLoggingConfig('INFO' if OPTIONS.verbose else 'WARNING')
   logging.config.dictConfig(config)
+  _default_logging_applied = True
 
 
 def Run(args, verbose=None, **kwargs):
@@ -192,7 +217,8 @@ def Run(args, verbose=None, **kwargs):
         stdin, etc. stdout and stderr will default to subprocess.PIPE and
         subprocess.STDOUT respectively unless caller specifies any of them.
         universal_newlines will default to True, as most of the users in
-        releasetools expect string output.
+        releasetools expect string output. close_fds will default to True, so
+        that descriptors leaked into this process aren't passed on.
 
   Returns:
     A subprocess.Popen object.
@@ -202,12 +228,38 @@ def Run(args, verbose=None, **kwargs):
     kwargs['stderr'] = subprocess.STDOUT
   if 'universal_newlines' not in kwargs:
     kwargs['universal_newlines'] = True
-  # Don't log any if caller explicitly says so.
-  if verbose != False:
+  kwargs.setdefault('close_fds', True)
+  # Don't log any if caller explicitly says so. Also skip building the message
+  # when INFO isn't enabled.
+  if verbose != False and logger.isEnabledFor(logging.INFO):
     logger.info("  Running: \"%s\"", " ".join(args))
   return subprocess.Popen(args, **kwargs)
 
 
+# Maps (program name, $PATH) to the program's resolved path.
+_which_cache = {}
+
+
+def _Which(name):
+  """Returns the path of the given program in $PATH.
+
+  The lookup is cached per $PATH, so that commands run many times don't need
+  exec to walk $PATH again each time. Returns the name itself if the program
+  can't be found, so that running it fails the same way as before.
+  """
+  search_path = os.environ.get("PATH", os.defpath)
+  key = (name, search_path)
+  if key not in _which_cache:
+    path = None
+    for directory in search_path.split(os.pathsep):
+      candidate = os.path.join(directory, name)
+      if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+        path = candidate
+        break
+    _which_cache[key] = path or name
+  return _which_cache[key]
+
+
 def RunAndWait(args, verbose=None, **kwargs):
   """Runs the given command waiting for it to complete.
 
@@ -250,8 +302,9 @@ def RunAndCheckOutput(args, verbose=None, **kwargs):
   """
   proc = Run(args, verbose=verbose, **kwargs)
   output, _ = proc.communicate()
-  # Don't log any if caller explicitly says so.
-  if verbose != False:
+  # Don't log any if caller explicitly says so. Also skip the rstrip() copy of
+  # a possibly large output when INFO isn't enabled.
+  if verbose != False and logger.isEnabledFor(logging.INFO):
     logger.info("%s", output.rstrip())
   if proc.returncode != 0:
     raise ExternalError(
@@ -261,20 +314,31 @@ def RunAndCheckOutput(args, verbose=None, **kwargs):
 
 
 def RoundUpTo4K(value):
-  rounded_up = value + 4095
-  return rounded_up - (rounded_up % 4096)
+  return (value + 4095) & ~4095
 
 
 def CloseInheritedPipes():
   """ Gmake in MAC OS has file descriptor (PIPE) leak. We close those fds
-  before doing other work."""
+  before doing other work.
+
+  Run() also starts every child with close_fds=True, which keeps such fds
+  from reaching the commands we invoke. The leak itself should be fixed in
+  make rather than worked around here."""
   if platform.system() != "Darwin":
     return
-  for d in range(3, 1025):
+  # Only probe the descriptors that are actually open, as listed in /dev/fd.
+  # Fall back to scanning the whole range if it isn't available.
+  try:
+    fds = [int(name) for name in os.listdir("/dev/fd")]
+  except OSError:
+    fds = range(3, 1025)
+  for d in fds:
+    if d < 3:
+      continue
     try:
-      stat = os.fstat(d)
-      if stat is not None:
-        pipebit = stat[0] & 0x1000
+      fd_stat = os.fstat(d)
+      if fd_stat is not None:
+        pipebit = fd_stat[0] & 0x1000
         if pipebit != 0:
           os.close(d)
     except OSError:
@@ -330,7 +394,7 @@ def LoadInfoDict(input_file, repacking=False):
           raise KeyError(fn)
 
   try:
-    d = LoadDictionaryFromLines(read_helper("META/misc_info.txt").split("\n"))
+    d = LoadDictionaryFromText(read_helper("META/misc_info.txt"))
   except KeyError:
     raise ValueError("Failed to find META/misc_info.txt in input target-files")
 
@@ -397,10 +461,12 @@ def LoadInfoDict(input_file, repacking=False):
   # cases, since it may load the info_dict from an old build (e.g. when
   # generating incremental OTAs from that build).
   system_root_image = d.get("system_root_image") == "true"
+  if isinstance(input_file, zipfile.ZipFile):
+    input_names = GetZipEntryNames(input_file)
   if d.get("no_recovery") != "true":
     recovery_fstab_path = "RECOVERY/RAMDISK/system/etc/recovery.fstab"
     if isinstance(input_file, zipfile.ZipFile):
-      if recovery_fstab_path not in input_file.namelist():
+      if recovery_fstab_path not in input_names:
         recovery_fstab_path = "RECOVERY/RAMDISK/etc/recovery.fstab"
     else:
       path = os.path.join(input_file, *recovery_fstab_path.split("/"))
@@ -412,7 +478,7 @@ def LoadInfoDict(input_file, repacking=False):
   elif d.get("recovery_as_boot") == "true":
     recovery_fstab_path = "BOOT/RAMDISK/system/etc/recovery.fstab"
     if isinstance(input_file, zipfile.ZipFile):
-      if recovery_fstab_path not in input_file.namelist():
+      if recovery_fstab_path not in input_names:
         recovery_fstab_path = "BOOT/RAMDISK/etc/recovery.fstab"
     else:
       path = os.path.join(input_file, *recovery_fstab_path.split("/"))
@@ -428,13 +494,19 @@ def LoadInfoDict(input_file, repacking=False):
   # system and vendor.
   for partition in PARTITIONS_WITH_CARE_MAP:
     partition_prop = "{}.build.prop".format(partition)
-    d[partition_prop] = LoadBuildProp(
-        read_helper, "{}/build.prop".format(partition.upper()))
     # Some partition might use /<partition>/etc/build.prop as the new path.
     # TODO: try new path first when majority of them switch to the new path.
-    if not d[partition_prop]:
-      d[partition_prop] = LoadBuildProp(
-          read_helper, "{}/etc/build.prop".format(partition.upper()))
+    prop_files = ["{}/build.prop".format(partition.upper()),
+                  "{}/etc/build.prop".format(partition.upper())]
+    # Most target_files only carry a few of the partitions; don't bother
+    # looking up the ones that aren't there.
+    if isinstance(input_file, zipfile.ZipFile):
+      prop_files = [fn for fn in prop_files if fn in input_names]
+    d[partition_prop] = {}
+    for prop_file in prop_files:
+      d[partition_prop] = LoadBuildProp(read_helper, prop_file)
+      if d[partition_prop]:
+        break
   d["build.prop"] = d["system.build.prop"]
 
   # Set up the salt (based on fingerprint or thumbprint) that will be used when
@@ -458,20 +530,35 @@ def LoadBuildProp(read_helper, prop_file):
     data = read_helper(prop_file)
   except KeyError:
     logger.warning("Failed to read %s", prop_file)
-    data = ""
-  return LoadDictionaryFromLines(data.split("\n"))
+    return {}
+  if not data or data.isspace():
+    return {}
+  return LoadDictionaryFromText(data)
+
+
+# Matches a "name=value" line, ignoring the surrounding whitespace. The name
+# may be empty, but otherwise it can't start with '#' (i.e. a comment line).
+_KEY_VALUE_LINE_RE = re.compile(
+    r"^[^\S\n]*((?:[^\s#=][^=\n]*)?)=([^\n]*?)[^\S\n]*$", re.MULTILINE)
+
+
+def LoadDictionaryFromText(data):
+  """Parses the "name=value" lines in the given string into a dict.
+
+  Blank lines, comment lines (starting with '#') and lines without '=' are
+  ignored.
+  """
+  return dict(_KEY_VALUE_LINE_RE.findall(data))
 
 
 def LoadDictionaryFromLines(lines):
-  d = {}
-  for line in lines:
-    line = line.strip()
-    if not line or line.startswith("#"):
-      continue
-    if "=" in line:
-      name, value = line.split("=", 1)
-      d[name] = value
-  return d
+  return LoadDictionaryFromText("\n".join(lines))
+
+
+# Extract the "length=" fs_mgr option and the "context=" mount flag from the
+# comma-separated lists in a recovery.fstab line.
+_FSTAB_LENGTH_RE = re.compile(r"(?:^|,)length=([^,]*)")
+_FSTAB_CONTEXT_RE = re.compile(r"(?:^|,)(context=[^,]*)")
 
 
 def LoadRecoveryFSTab(read_helper, fstab_version, recovery_fstab_path,
@@ -508,22 +595,19 @@ def LoadRecoveryFSTab(read_helper, fstab_version, recovery_fstab_path,
     if "voldmanaged=" in options:
       continue
 
-    # It's a good line, parse it.
+    # It's a good line, parse it. Ignore all unknown options in the unified
+    # fstab. The last occurrence wins if an option is given more than once.
     length = 0
-    options = options.split(",")
-    for i in options:
-      if i.startswith("length="):
-        length = int(i[7:])
-      else:
-        # Ignore all unknown options in the unified fstab.
-        continue
+    lengths = _FSTAB_LENGTH_RE.findall(options)
+    if lengths:
+      length = int(lengths[-1])
 
     mount_flags = pieces[3]
     # Honor the SELinux context if present.
     context = None
-    for i in mount_flags.split(","):
-      if i.startswith("context="):
-        context = i
+    contexts = _FSTAB_CONTEXT_RE.findall(mount_flags)
+    if contexts:
+      context = contexts[-1]
 
     mount_point = pieces[1]
     if not d.get(mount_point):
@@ -537,7 +621,7 @@ def LoadRecoveryFSTab(read_helper, fstab_version, recovery_fstab_path,
     assert '/system' not in d and '/' in d
     d["/system"] = d["/"]
 
-  if force_vendor and not d.has_key("/vendor"):
+  if force_vendor and "/vendor" not in d:
     system_part = d["/system"]
     vendor_part = Partition(mount_point = "/vendor",
                             fs_type = system_part.fs_type,
@@ -604,16 +688,21 @@ def _BuildBootableImage(sourcedir, fs_config_file, info_dict=None,
   for building the requested image.
   """
 
+  # Paths of the input files, all of which live directly under sourcedir.
+  prefix = os.path.join(sourcedir, "")
+
   def make_ramdisk():
     ramdisk_img = tempfile.NamedTemporaryFile()
 
     if os.access(fs_config_file, os.F_OK):
-      cmd = ["mkbootfs", "-f", fs_config_file,
-             os.path.join(sourcedir, "RAMDISK")]
+      cmd = ["mkbootfs", "-f", fs_config_file, prefix + "RAMDISK"]
     else:
-      cmd = ["mkbootfs", os.path.join(sourcedir, "RAMDISK")]
+      cmd = ["mkbootfs", prefix + "RAMDISK"]
     p1 = Run(cmd, stdout=subprocess.PIPE)
     p2 = Run(["minigzip"], stdin=p1.stdout, stdout=ramdisk_img.file.fileno())
+    # Drop our copy of the read end, so that minigzip is the only reader and
+    # mkbootfs gets SIGPIPE (rather than blocking) if minigzip exits early.
+    p1.stdout.close()
 
     p2.wait()
     p1.wait()
@@ -622,10 +711,16 @@ def _BuildBootableImage(sourcedir, fs_config_file, info_dict=None,
 
     return ramdisk_img
 
-  if not os.access(os.path.join(sourcedir, "kernel"), os.F_OK):
+  # List sourcedir once, instead of probing each of the optional inputs.
+  try:
+    present = set(os.listdir(sourcedir))
+  except OSError:
+    return None
+
+  if "kernel" not in present:
     return None
 
-  if has_ramdisk and not os.access(os.path.join(sourcedir, "RAMDISK"), os.F_OK):
+  if has_ramdisk and "RAMDISK" not in present:
     return None
 
   if info_dict is None:
@@ -639,47 +734,29 @@ def _BuildBootableImage(sourcedir, fs_config_file, info_dict=None,
   # use MKBOOTIMG from environ, or "mkbootimg" if empty or not set
   mkbootimg = os.getenv('MKBOOTIMG') or "mkbootimg"
 
-  cmd = [mkbootimg, "--kernel", os.path.join(sourcedir, "kernel")]
+  cmd = [mkbootimg, "--kernel", prefix + "kernel"]
 
-  fn = os.path.join(sourcedir, "second")
-  if os.access(fn, os.F_OK):
+  if "second" in present:
     cmd.append("--second")
-    cmd.append(fn)
+    cmd.append(prefix + "second")
 
-  fn = os.path.join(sourcedir, "dtb")
-  if os.access(fn, os.F_OK):
+  if "dtb" in present:
     cmd.append("--dtb")
-    cmd.append(fn)
-
-  fn = os.path.join(sourcedir, "cmdline")
-  if os.access(fn, os.F_OK):
-    cmd.append("--cmdline")
-    cmd.append(open(fn).read().rstrip("\n"))
-
-  fn = os.path.join(sourcedir, "base")
-  if os.access(fn, os.F_OK):
-    cmd.append("--base")
-    cmd.append(open(fn).read().rstrip("\n"))
-
-  fn = os.path.join(sourcedir, "pagesize")
-  if os.access(fn, os.F_OK):
-    cmd.append("--pagesize")
-    cmd.append(open(fn).read().rstrip("\n"))
-
-  fn = os.path.join(sourcedir, "tagsaddr")
-  if os.access(fn, os.F_OK):
-    cmd.append("--tags-addr")
-    cmd.append(open(fn).read().rstrip("\n"))
-
-  fn = os.path.join(sourcedir, "ramdisk_offset")
-  if os.access(fn, os.F_OK):
-    cmd.append("--ramdisk_offset")
-    cmd.append(open(fn).read().rstrip("\n"))
-
-  fn = os.path.join(sourcedir, "dt")
-  if os.access(fn, os.F_OK):
+    cmd.append(prefix + "dtb")
+
+  # The values of these args are stored as the content of the files.
+  for name, arg in (("cmdline", "--cmdline"),
+                    ("base", "--base"),
+                    ("pagesize", "--pagesize"),
+                    ("tagsaddr", "--tags-addr"),
+                    ("ramdisk_offset", "--ramdisk_offset")):
+    if name in present:
+      with open(prefix + name) as f:
+        cmd.extend([arg, f.read().rstrip("\n")])
+
+  if "dt" in present:
     cmd.append("--dt")
-    cmd.append(fn)
+    cmd.append(prefix + "dt")
 
   args = info_dict.get("mkbootimg_args")
   if args and args.strip():
@@ -704,10 +781,10 @@ def _BuildBootableImage(sourcedir, fs_config_file, info_dict=None,
 
   if partition_name == "recovery":
     if info_dict.get("include_recovery_dtbo") == "true":
-      fn = os.path.join(sourcedir, "recovery_dtbo")
+      fn = prefix + "recovery_dtbo"
       cmd.extend(["--recovery_dtbo", fn])
     if info_dict.get("include_recovery_acpio") == "true":
-      fn = os.path.join(sourcedir, "recovery_acpio")
+      fn = prefix + "recovery_acpio"
       cmd.extend(["--recovery_acpio", fn])
 
   RunAndCheckOutput(cmd)
@@ -762,11 +839,14 @@ def _BuildBootableImage(sourcedir, fs_config_file, info_dict=None,
       cmd.extend(shlex.split(args))
     RunAndCheckOutput(cmd)
 
-  img.seek(os.SEEK_SET, 0)
-  data = img.read()
-
+  # Release the ramdisk before pulling the (possibly large) image into memory.
   if has_ramdisk:
     ramdisk_img.close()
+
+  # Callers wrap the result into a File, which needs the actual bytes (for the
+  # SHA-1, comparisons and zip writes), so read it in a single call.
+  img.seek(0, os.SEEK_SET)
+  data = img.read()
   img.close()
 
   return data
@@ -815,7 +895,70 @@ def Gunzip(in_filename, out_filename):
   """Gunzips the given gzip compressed file to a given output file."""
   with gzip.open(in_filename, "rb") as in_file, \
        open(out_filename, "wb") as out_file:
-    shutil.copyfileobj(in_file, out_file)
+    # The default 16KiB chunks make the copy dominated by per-chunk overhead on
+    # large images; use 1MiB chunks instead.
+    shutil.copyfileobj(in_file, out_file, 1 << 20)
+
+
+def _ExtractZipEntry(input_zip, info, dirname):
+  """Extracts a single ZIP entry under dirname, like 'unzip -o' would.
+
+  Unlike ZipFile.extract(), it restores the permission bits and modification
+  time, and recreates symlinks, which are stored with their target as the entry
+  data. File contents are copied in 1MiB chunks, where ZipFile.extract() uses
+  16KiB ones. An existing file is unlinked first rather than written in place,
+  so read-only files can be replaced and hard links aren't written through.
+  """
+  # Drop the empty, '.' and '..' components, as ZipFile.extract() does.
+  components = [c for c in info.filename.split("/")
+                if c not in ("", os.path.curdir, os.path.pardir)]
+  if not components:
+    return
+  path = os.path.join(dirname, *components)
+
+  if info.filename.endswith("/"):
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    return
+
+  parent = os.path.dirname(path)
+  if not os.path.isdir(parent):
+    os.makedirs(parent)
+  if os.path.lexists(path) and not os.path.isdir(path):
+    os.remove(path)
+
+  mode = info.external_attr >> 16
+  if stat.S_ISLNK(mode):
+    os.symlink(input_zip.read(info).decode(), path)
+    return
+
+  with input_zip.open(info) as src, open(path, "wb") as dst:
+    shutil.copyfileobj(src, dst, 1 << 20)
+  if mode & 0o777:
+    os.chmod(path, mode & 0o777)
+  # ZIP timestamps are in local time, as 'unzip' interprets them.
+  mtime = time.mktime(info.date_time + (0, 0, -1))
+  os.utime(path, (mtime, mtime))
+
+
+def _CompileFnmatchPatterns(patterns):
+  """Compiles the given fnmatch patterns into a single regex.
+
+  The returned regex matches a name if any of the patterns does. It never
+  matches if the list is empty.
+  """
+  translated = []
+  for pattern in patterns:
+    regex = fnmatch.translate(pattern)
+    # Python 2 appends global flags ("a.*\Z(?ms)"). Drop them: re.DOTALL is
+    # set on the joined pattern below, and translations contain no ^ or $ for
+    # MULTILINE to affect.
+    if regex.endswith("(?ms)"):
+      regex = regex[:-len("(?ms)")]
+    translated.append("(?:%s)" % regex)
+  if not translated:
+    translated.append("(?!)")
+  return re.compile("|".join(translated), re.DOTALL)
 
 
 def UnzipToDir(filename, dirname, patterns=None):
@@ -828,20 +971,20 @@ def UnzipToDir(filename, dirname, patterns=None):
         archvie. Non-matching patterns will be filtered out. If there's no match
         after the filtering, no file will be unzipped.
   """
-  cmd = ["unzip", "-o", "-q", filename, "-d", dirname]
-  if patterns is not None:
-    # Filter out non-matching patterns. unzip will complain otherwise.
-    with zipfile.ZipFile(filename) as input_zip:
-      names = input_zip.namelist()
-    filtered = [
-        pattern for pattern in patterns if fnmatch.filter(names, pattern)]
-
-    # There isn't any matching files. Don't unzip anything.
-    if not filtered:
-      return
-    cmd.extend(filtered)
+  # Extract in-process, which reads the central directory only once and saves
+  # spawning 'unzip'.
+  with zipfile.ZipFile(filename) as input_zip:
+    infos = input_zip.infolist()
+    if patterns is not None:
+      pattern_re = _CompileFnmatchPatterns(patterns)
+      infos = [info for info in infos if pattern_re.match(info.filename)]
 
-  RunAndCheckOutput(cmd)
+    for info in infos:
+      _ExtractZipEntry(input_zip, info, dirname)
+
+
+# Matches the "foo.zip+bar.zip" form accepted by UnzipTemp().
+_ZIP_CONCAT_RE = re.compile(r"^(.*[.]zip)\+(.*[.]zip)$", re.IGNORECASE)
 
 
 def UnzipTemp(filename, pattern=None):
@@ -859,7 +1002,7 @@ def UnzipTemp(filename, pattern=None):
   """
 
   tmp = MakeTempDir(prefix="targetfiles-")
-  m = re.match(r"^(.*[.]zip)\+(.*[.]zip)$", filename, re.IGNORECASE)
+  m = _ZIP_CONCAT_RE.match(filename)
   if m:
     UnzipToDir(m.group(1), tmp, pattern)
     UnzipToDir(m.group(2), os.path.join(tmp, "BOOTABLE_IMAGES"), pattern)
@@ -935,11 +1078,18 @@ def GetNonSparseImage(which, tmpdir, hashtree_info_generator=None):
   mappath = os.path.join(tmpdir, "IMAGES", which + ".map")
 
   # The image and map files must have been created prior to calling
-  # ota_from_target_files.py (since LMP).
-  assert os.path.exists(path) and os.path.exists(mappath)
-
-  return blockimgdiff.FileImage(path, hashtree_info_generator=
-                                hashtree_info_generator)
+  # ota_from_target_files.py (since LMP). FileImage doesn't read the map, so
+  # check it here; let the open() in FileImage report a missing image instead
+  # of stat'ing it up front.
+  if not os.path.exists(mappath):
+    raise ExternalError("Missing {}".format(mappath))
+  try:
+    return blockimgdiff.FileImage(path, hashtree_info_generator=
+                                  hashtree_info_generator)
+  except (IOError, OSError) as e:
+    if e.errno != errno.ENOENT:
+      raise
+    raise ExternalError("Missing {}: {}".format(path, e))
 
 def GetSparseImage(which, tmpdir, input_zip, allow_shared_blocks,
                    hashtree_info_generator=None):
@@ -964,21 +1114,33 @@ def GetSparseImage(which, tmpdir, input_zip, allow_shared_blocks,
   mappath = os.path.join(tmpdir, "IMAGES", which + ".map")
 
   # The image and map files must have been created prior to calling
-  # ota_from_target_files.py (since LMP).
-  assert os.path.exists(path) and os.path.exists(mappath)
+  # ota_from_target_files.py (since LMP). A missing one is reported by the
+  # open() calls in SparseImage.
 
   # In ext4 filesystems, block 0 might be changed even being mounted R/O. We add
   # it to clobbered_blocks so that it will be written to the target
   # unconditionally. Note that they are still part of care_map. (Bug: 20939131)
   clobbered_blocks = "0"
 
-  image = sparse_img.SparseImage(
-      path, mappath, clobbered_blocks, allow_shared_blocks=allow_shared_blocks,
-      hashtree_info_generator=hashtree_info_generator)
+  try:
+    image = sparse_img.SparseImage(
+        path, mappath, clobbered_blocks,
+        allow_shared_blocks=allow_shared_blocks,
+        hashtree_info_generator=hashtree_info_generator)
+  except (IOError, OSError) as e:
+    if e.errno != errno.ENOENT:
+      raise
+    raise ExternalError("Missing {} or {}: {}".format(path, mappath, e))
 
   # block.map may contain less blocks, because mke2fs may skip allocating blocks
   # if they contain all zeros. We can't reconstruct such a file from its block
   # list. Tag such entries accordingly. (Bug: 65213616)
+  # Look entries up in the dict zipfile maintains, rather than through
+  # getinfo(), which raises KeyError for a missing one.
+  name_to_info = input_zip.NameToInfo
+  which_upper = which.upper()
+  which_len = len(which)
+  is_system = which == 'system'
   for entry in image.file_map:
     # Skip artificial names, such as "__ZERO", "__NONZERO-1".
     if not entry.startswith('/'):
@@ -987,18 +1149,23 @@ def GetSparseImage(which, tmpdir, input_zip, allow_shared_blocks,
     # "/system/framework/am.jar" => "SYSTEM/framework/am.jar". Note that the
     # filename listed in system.map may contain an additional leading slash
     # (i.e. "//system/framework/am.jar"). Using lstrip to get consistent
-    # results.
-    arcname = entry.replace(which, which.upper(), 1).lstrip('/')
+    # results. Most entries start with the partition name, which only takes a
+    # prefix swap; otherwise the first occurrence of it gets replaced.
+    arcname = entry.lstrip('/')
+    if arcname.startswith(which):
+      arcname = which_upper + arcname[which_len:]
+    else:
+      arcname = entry.replace(which, which_upper, 1).lstrip('/')
 
     # Special handling another case, where files not under /system
     # (e.g. "/sbin/charger") are packed under ROOT/ in a target_files.zip.
-    if which == 'system' and not arcname.startswith('SYSTEM'):
+    if is_system and not arcname.startswith('SYSTEM'):
       arcname = 'ROOT/' + arcname
 
-    assert arcname in input_zip.namelist(), \
+    info = name_to_info.get(arcname)
+    assert info is not None, \
         "Failed to find the ZIP entry for {}".format(entry)
 
-    info = input_zip.getinfo(arcname)
     ranges = image.file_map[entry]
 
     # If a RangeSet has been tagged as using shared blocks while loading the
@@ -1013,6 +1180,84 @@ def GetSparseImage(which, tmpdir, input_zip, allow_shared_blocks,
   return image
 
 
+def _ProbeDerPkcs8Key(filename):
+  """Tells whether the given DER PKCS#8 key file is encrypted.
+
+  Only the first few bytes are parsed. An unencrypted PrivateKeyInfo starts with
+  SEQUENCE { INTEGER 0, ... }, while an EncryptedPrivateKeyInfo starts with
+  SEQUENCE { SEQUENCE (AlgorithmIdentifier), ... }.
+
+  Returns:
+    True if the key is encrypted, False if it's not, or None if it can't be
+    told (e.g. the file is missing or not in the expected format).
+  """
+  try:
+    with open(filename, "rb") as f:
+      header = bytearray(f.read(16))
+  except IOError:
+    return None
+
+  # The outer SEQUENCE, with its length in short or long form.
+  if len(header) < 2 or header[0] != 0x30:
+    return None
+  if header[1] < 0x80:
+    offset = 2
+  else:
+    offset = 2 + (header[1] & 0x7f)
+  if offset > 6 or len(header) < offset + 3:
+    return None
+
+  if header[offset:offset + 3] == bytearray(b"\x02\x01\x00"):
+    return False
+  if header[offset] == 0x30:
+    return True
+  return None
+
+
+def _ProbeKeyPassword(key, maybe_unencrypted):
+  """Runs openssl to find out whether the given key needs a password.
+
+  Args:
+    key: The key name, without the private key suffix.
+    maybe_unencrypted: Whether to check for an unencrypted key first.
+
+  Returns:
+    None if the key doesn't need a password (or isn't understood by openssl),
+    '' if it's encrypted with an empty password, or False if it needs one.
+  """
+  openssl = _Which("openssl")
+  with open("/dev/null", "w+b") as devnull:
+    if maybe_unencrypted:
+      p = Run([openssl, "pkcs8", "-in", key+OPTIONS.private_key_suffix,
+               "-inform", "DER", "-nocrypt"],
+              stdin=devnull.fileno(),
+              stdout=devnull.fileno(),
+              stderr=subprocess.STDOUT)
+      p.communicate()
+      if p.returncode == 0:
+        # Definitely an unencrypted key.
+        return None
+
+    # Still need to find out whether the key is encrypted with an empty
+    # password.
+    p = Run([openssl, "pkcs8", "-in", key+OPTIONS.private_key_suffix,
+             "-inform", "DER", "-passin", "pass:"],
+            stdin=devnull.fileno(),
+            stdout=devnull.fileno(),
+            stderr=subprocess.PIPE)
+    _, stderr = p.communicate()
+  if p.returncode == 0:
+    # Encrypted key with empty string as password.
+    return ''
+  elif stderr.startswith('Error decrypting key'):
+    # Definitely encrypted key.
+    # It would have said "Error reading key" if it didn't parse correctly.
+    return False
+  # Potentially, a type of key that openssl doesn't understand.
+  # We'll let the routines in signapk.jar handle it.
+  return None
+
+
 def GetKeyPasswords(keylist):
   """Given a list of keys, prompt the user to enter passwords for
   those which require them.  Return a {key: password} dict.  password
@@ -1021,52 +1266,60 @@ def GetKeyPasswords(keylist):
   no_passwords = []
   need_passwords = []
   key_passwords = {}
-  devnull = open("/dev/null", "w+b")
+  to_probe = []
   for k in sorted(keylist):
     # We don't need a password for things that aren't really keys.
     if k in SPECIAL_CERT_STRINGS:
       no_passwords.append(k)
       continue
 
-    p = Run(["openssl", "pkcs8", "-in", k+OPTIONS.private_key_suffix,
-             "-inform", "DER", "-nocrypt"],
-            stdin=devnull.fileno(),
-            stdout=devnull.fileno(),
-            stderr=subprocess.STDOUT)
-    p.communicate()
-    if p.returncode == 0:
-      # Definitely an unencrypted key.
+    # Classify the key in-process where possible, and only ask openssl when
+    # the DER header isn't recognized or the key is encrypted.
+    encrypted = _ProbeDerPkcs8Key(k + OPTIONS.private_key_suffix)
+    if encrypted is False:
       no_passwords.append(k)
-    else:
-      p = Run(["openssl", "pkcs8", "-in", k+OPTIONS.private_key_suffix,
-               "-inform", "DER", "-passin", "pass:"],
-              stdin=devnull.fileno(),
-              stdout=devnull.fileno(),
-              stderr=subprocess.PIPE)
-      _, stderr = p.communicate()
-      if p.returncode == 0:
-        # Encrypted key with empty string as password.
-        key_passwords[k] = ''
-      elif stderr.startswith('Error decrypting key'):
-        # Definitely encrypted key.
-        # It would have said "Error reading key" if it didn't parse correctly.
+      continue
+    to_probe.append((k, encrypted is None))
+
+  # The openssl probes are independent of each other, so run them in
+  # parallel. The results come back in the (sorted) order of to_probe.
+  if to_probe:
+    pool = multiprocessing.pool.ThreadPool(
+        min(len(to_probe),
+            OPTIONS.worker_threads or multiprocessing.cpu_count()))
+    try:
+      results = pool.map(lambda args: _ProbeKeyPassword(*args), to_probe)
+    finally:
+      pool.close()
+      pool.join()
+
+    for (k, _), result in zip(to_probe, results):
+      if result is None:
+        no_passwords.append(k)
+      elif result is False:
         need_passwords.append(k)
       else:
-        # Potentially, a type of key that openssl doesn't understand.
-        # We'll let the routines in signapk.jar handle it.
-        no_passwords.append(k)
-  devnull.close()
+        key_passwords[k] = result
 
   key_passwords.update(PasswordManager().GetPasswords(need_passwords))
   key_passwords.update(dict.fromkeys(no_passwords))
   return key_passwords
 
 
+# Matches lines such as sdkVersion:'23' or sdkVersion:'M' in the output of
+# 'aapt2 dump badging'.
+_SDK_VERSION_RE = re.compile(r"^sdkVersion:'([^']*)'", re.MULTILINE)
+
+# Maps (abspath, mtime, size) of an APK to its minSdkVersion.
+_min_sdk_version_cache = {}
+
+
 def GetMinSdkVersion(apk_name):
   """Gets the minSdkVersion declared in the APK.
 
   It calls 'aapt2' to query the embedded minSdkVersion from the given APK file.
-  This can be both a decimal number (API Level) or a codename.
+  This can be both a decimal number (API Level) or a codename. The result is
+  cached, as long as the APK file stays unchanged.
 
   Args:
     apk_name: The APK filename.
@@ -1077,8 +1330,17 @@ def GetMinSdkVersion(apk_name):
   Raises:
     ExternalError: On failing to obtain the min SDK version.
   """
+  try:
+    apk_stat = os.stat(apk_name)
+    cache_key = (os.path.abspath(apk_name), apk_stat.st_mtime,
+                 apk_stat.st_size)
+  except OSError:
+    cache_key = None
+  if cache_key in _min_sdk_version_cache:
+    return _min_sdk_version_cache[cache_key]
+
   proc = Run(
-      ["aapt2", "dump", "badging", apk_name], stdout=subprocess.PIPE,
+      [_Which("aapt2"), "dump", "badging", apk_name], stdout=subprocess.PIPE,
       stderr=subprocess.PIPE)
   stdoutdata, stderrdata = proc.communicate()
   if proc.returncode != 0:
@@ -1086,12 +1348,12 @@ def GetMinSdkVersion(apk_name):
         "Failed to obtain minSdkVersion: aapt2 return code {}:\n{}\n{}".format(
             proc.returncode, stdoutdata, stderrdata))
 
-  for line in stdoutdata.split("\n"):
-    # Looking for lines such as sdkVersion:'23' or sdkVersion:'M'.
-    m = re.match(r'sdkVersion:\'([^\']*)\'', line)
-    if m:
-      return m.group(1)
-  raise ExternalError("No minSdkVersion returned by aapt2")
+  m = _SDK_VERSION_RE.search(stdoutdata)
+  if not m:
+    raise ExternalError("No minSdkVersion returned by aapt2")
+  if cache_key is not None:
+    _min_sdk_version_cache[cache_key] = m.group(1)
+  return m.group(1)
 
 
 def GetMinSdkVersionInt(apk_name, codename_to_api_level_map):
@@ -1230,6 +1492,11 @@ def CheckSize(data, target, info_dict):
       logger.info("  %s", msg)
 
 
+_APKCERTS_LINE_RE = re.compile(
+    r'^name="(?P<NAME>.*)"\s+certificate="(?P<CERT>.*)"\s+'
+    r'private_key="(?P<PRIVKEY>.*?)"(\s+compressed="(?P<COMPRESSED>.*)")?$')
+
+
 def ReadApkCerts(tf_zip):
   """Parses the APK certs info from a given target-files zip.
 
@@ -1251,59 +1518,68 @@ def ReadApkCerts(tf_zip):
   compressed_extension = None
 
   # META/apkcerts.txt contains the info for _all_ the packages known at build
-  # time. Filter out the ones that are not installed.
-  installed_files = set()
-  for name in tf_zip.namelist():
-    basename = os.path.basename(name)
-    if basename:
-      installed_files.add(basename)
-
-  for line in tf_zip.read('META/apkcerts.txt').decode().split('\n'):
-    line = line.strip()
-    if not line:
-      continue
-    m = re.match(
-        r'^name="(?P<NAME>.*)"\s+certificate="(?P<CERT>.*)"\s+'
-        r'private_key="(?P<PRIVKEY>.*?)"(\s+compressed="(?P<COMPRESSED>.*)")?$',
-        line)
-    if not m:
-      continue
+  # time. Filter out the ones that are not installed. The set is only built
+  # once we come across a compressed APK.
+  installed_files = None
+
+  public_key_suffix = OPTIONS.public_key_suffix
+  private_key_suffix = OPTIONS.private_key_suffix
+  public_key_suffix_len = len(public_key_suffix)
+  private_key_suffix_len = len(private_key_suffix)
+
+  # Iterate over the entry instead of reading it into one big string first.
+  with tf_zip.open('META/apkcerts.txt') as apkcerts_file:
+    apkcerts_lines = io.TextIOWrapper(apkcerts_file, encoding='utf-8')
+    for line in apkcerts_lines:
+      line = line.strip()
+      if not line:
+        continue
+      m = _APKCERTS_LINE_RE.match(line)
+      if not m:
+        continue
 
-    matches = m.groupdict()
-    cert = matches["CERT"]
-    privkey = matches["PRIVKEY"]
-    name = matches["NAME"]
-    this_compressed_extension = matches["COMPRESSED"]
-
-    public_key_suffix_len = len(OPTIONS.public_key_suffix)
-    private_key_suffix_len = len(OPTIONS.private_key_suffix)
-    if cert in SPECIAL_CERT_STRINGS and not privkey:
-      certmap[name] = cert
-    elif (cert.endswith(OPTIONS.public_key_suffix) and
-          privkey.endswith(OPTIONS.private_key_suffix) and
-          cert[:-public_key_suffix_len] == privkey[:-private_key_suffix_len]):
-      certmap[name] = cert[:-public_key_suffix_len]
-    else:
-      raise ValueError("Failed to parse line from apkcerts.txt:\n" + line)
+      matches = m.groupdict()
+      cert = matches["CERT"]
+      privkey = matches["PRIVKEY"]
+      name = matches["NAME"]
+      this_compressed_extension = matches["COMPRESSED"]
+
+      if cert in SPECIAL_CERT_STRINGS and not privkey:
+        certmap[name] = cert
+      elif (cert.endswith(public_key_suffix) and
+            privkey.endswith(private_key_suffix)):
+        # Slice the key stem once and reuse it for the result.
+        stem = cert[:-public_key_suffix_len]
+        if privkey[:-private_key_suffix_len] != stem:
+          raise ValueError("Failed to parse line from apkcerts.txt:\n" + line)
+        certmap[name] = stem
+      else:
+        raise ValueError("Failed to parse line from apkcerts.txt:\n" + line)
 
-    if not this_compressed_extension:
-      continue
+      if not this_compressed_extension:
+        continue
 
-    # Only count the installed files.
-    filename = name + '.' + this_compressed_extension
-    if filename not in installed_files:
-      continue
+      # Only count the installed files.
+      if installed_files is None:
+        installed_files = set()
+        for entry in tf_zip.namelist():
+          basename = os.path.basename(entry)
+          if basename:
+            installed_files.add(basename)
+      filename = name + '.' + this_compressed_extension
+      if filename not in installed_files:
+        continue
 
-    # Make sure that all the values in the compression map have the same
-    # extension. We don't support multiple compression methods in the same
-    # system image.
-    if compressed_extension:
-      if this_compressed_extension != compressed_extension:
-        raise ValueError(
-            "Multiple compressed extensions: {} vs {}".format(
-                compressed_extension, this_compressed_extension))
-    else:
-      compressed_extension = this_compressed_extension
+      # Make sure that all the values in the compression map have the same
+      # extension. We don't support multiple compression methods in the same
+      # system image.
+      if compressed_extension:
+        if this_compressed_extension != compressed_extension:
+          raise ValueError(
+              "Multiple compressed extensions: {} vs {}".format(
+                  compressed_extension, this_compressed_extension))
+      else:
+        compressed_extension = this_compressed_extension
 
   return (certmap,
           ("." + compressed_extension) if compressed_extension else None)
@@ -1411,7 +1687,7 @@ def MakeTempFile(prefix='tmp', suffix=''):
   when Cleanup() is called.  Return the filename."""
   fd, fn = tempfile.mkstemp(prefix=prefix, suffix=suffix)
   os.close(fd)
-  OPTIONS.tempfiles.append(fn)
+  OPTIONS.tempfiles.append((fn, False))
   return fn
 
 
@@ -1422,19 +1698,63 @@ def MakeTempDir(prefix='tmp', suffix=''):
     The absolute pathname of the new directory.
   """
   dir_name = tempfile.mkdtemp(suffix=suffix, prefix=prefix)
-  OPTIONS.tempfiles.append(dir_name)
+  OPTIONS.tempfiles.append((dir_name, True))
   return dir_name
 
 
 def Cleanup():
-  for i in OPTIONS.tempfiles:
-    if os.path.isdir(i):
-      shutil.rmtree(i, ignore_errors=True)
+  # OPTIONS.tempfiles holds (path, is_dir) tuples, so that no stat is needed
+  # here. Plain paths may still be added by others; stat those ones.
+  for item in OPTIONS.tempfiles:
+    if isinstance(item, tuple):
+      path, is_dir = item
+    else:
+      path, is_dir = item, os.path.isdir(item)
+    if is_dir:
+      shutil.rmtree(path, ignore_errors=True)
     else:
-      os.remove(i)
+      os.remove(path)
   del OPTIONS.tempfiles[:]
 
 
+# Matches a "[[[ password ]]] key" line in the password file, capturing the
+# password and the key. Any other line that's neither blank nor a comment is
+# captured by the third group, so that it can be reported.
+_PASSWORD_LINE_RE = re.compile(
+    r"^[^\S\n]*(?:\[\[\[[^\S\n]*(.*?)[^\S\n]*\]\]\][^\S\n]*(\S+)|"
+    r"([^#\s][^\n]*?))[^\S\n]*$", re.MULTILINE)
+
+
+def _ReadPassword(tty_fd, prompt):
+  """Prompts for a password on the given terminal, with echo turned off.
+
+  Falls back to getpass.getpass() if there's no terminal (tty_fd is None).
+  """
+  if tty_fd is None:
+    return getpass.getpass(prompt)
+
+  old_attrs = termios.tcgetattr(tty_fd)
+  new_attrs = list(old_attrs)
+  new_attrs[3] &= ~termios.ECHO
+  data = b""
+  try:
+    termios.tcsetattr(tty_fd, termios.TCSAFLUSH, new_attrs)
+    os.write(tty_fd, prompt.encode())
+    while not data.endswith(b"\n"):
+      chunk = os.read(tty_fd, 1024)
+      if not chunk:
+        break
+      data += chunk
+  finally:
+    termios.tcsetattr(tty_fd, termios.TCSAFLUSH, old_attrs)
+    os.write(tty_fd, b"\n")
+  if not data:
+    raise EOFError
+  if not isinstance(data, str):
+    data = data.decode()
+  return data.rstrip("\n")
+
+
 class PasswordManager(object):
   def __init__(self):
     self.editor = os.getenv("EDITOR")
@@ -1498,15 +1818,25 @@ class PasswordManager(object):
     values.
     """
     result = {}
-    for k, v in sorted(current.items()):
-      if v:
-        result[k] = v
-      else:
-        while True:
-          result[k] = getpass.getpass(
-              "Enter password for %s key> " % k).strip()
-          if result[k]:
-            break
+    # Open the terminal once for all the prompts, rather than having getpass
+    # open and set it up for each of them.
+    try:
+      tty_fd = os.open("/dev/tty", os.O_RDWR | os.O_NOCTTY)
+    except OSError:
+      tty_fd = None
+    try:
+      for k, v in sorted(current.items()):
+        if v:
+          result[k] = v
+        else:
+          while True:
+            result[k] = _ReadPassword(
+                tty_fd, "Enter password for %s key> " % k).strip()
+            if result[k]:
+              break
+    finally:
+      if tty_fd is not None:
+        os.close(tty_fd)
     return result
 
   def UpdateAndReadFile(self, current):
@@ -1536,23 +1866,49 @@ class PasswordManager(object):
     if self.pwfile is None:
       return result
     try:
-      f = open(self.pwfile, "r")
-      for line in f:
-        line = line.strip()
-        if not line or line[0] == '#':
-          continue
-        m = re.match(r"^\[\[\[\s*(.*?)\s*\]\]\]\s*(\S+)$", line)
-        if not m:
-          logger.warning("Failed to parse password file: %s", line)
+      with open(self.pwfile, "r") as f:
+        data = f.read()
+      # Scan the whole file at once, rather than stripping and matching it
+      # line by line.
+      for m in _PASSWORD_LINE_RE.finditer(data):
+        password, key, unparsed = m.groups()
+        if unparsed is not None:
+          logger.warning("Failed to parse password file: %s", unparsed)
         else:
-          result[m.group(2)] = m.group(1)
-      f.close()
+          result[key] = password
     except IOError as e:
       if e.errno != errno.ENOENT:
         logger.exception("Error reading password file:")
     return result
 
 
+# http://b/18015246
+# zipfile assumes zip64 is required past ZIP64_LIMIT, which is 2GiB on both
+# Python 2 and 3. The Zip* helpers below raise it to 4GiB while they run. As
+# it's a module-level global, count the active users so that concurrent calls
+# from different threads don't restore it while others still rely on it.
+_zip64_limit_lock = threading.Lock()
+_zip64_limit_users = 0
+_saved_zip64_limit = None
+
+
+@contextlib.contextmanager
+def _RaisedZip64Limit():
+  global _zip64_limit_users, _saved_zip64_limit
+  with _zip64_limit_lock:
+    if _zip64_limit_users == 0:
+      _saved_zip64_limit = zipfile.ZIP64_LIMIT
+      zipfile.ZIP64_LIMIT = (1 << 32) - 1
+    _zip64_limit_users += 1
+  try:
+    yield
+  finally:
+    with _zip64_limit_lock:
+      _zip64_limit_users -= 1
+      if _zip64_limit_users == 0:
+        zipfile.ZIP64_LIMIT = _saved_zip64_limit
+
+
 def ZipWrite(zip_file, filename, arcname=None, perms=0o644,
              compress_type=None):
   import datetime
@@ -1566,9 +1922,6 @@ def ZipWrite(zip_file, filename, arcname=None, perms=0o644,
   # `zipfile.write()` must be used directly to work around this.
   #
   # This mess can be avoided if we port to python3.
-  saved_zip64_limit = zipfile.ZIP64_LIMIT
-  zipfile.ZIP64_LIMIT = (1 << 32) - 1
-
   if compress_type is None:
     compress_type = zip_file.compression
   if arcname is None:
@@ -1590,11 +1943,11 @@ def ZipWrite(zip_file, filename, arcname=None, perms=0o644,
     timestamp = (datetime.datetime(2009, 1, 1) - local_epoch).total_seconds()
     os.utime(filename, (timestamp, timestamp))
 
-    zip_file.write(filename, arcname=arcname, compress_type=compress_type)
+    with _RaisedZip64Limit():
+      zip_file.write(filename, arcname=arcname, compress_type=compress_type)
   finally:
     os.chmod(filename, saved_stat.st_mode)
     os.utime(filename, (saved_stat.st_atime, saved_stat.st_mtime))
-    zipfile.ZIP64_LIMIT = saved_zip64_limit
 
 
 def ZipWriteStr(zip_file, zinfo_or_arcname, data, perms=None,
@@ -1610,9 +1963,6 @@ def ZipWriteStr(zip_file, zinfo_or_arcname, data, perms=None,
   when we know the string won't be too long.
   """
 
-  saved_zip64_limit = zipfile.ZIP64_LIMIT
-  zipfile.ZIP64_LIMIT = (1 << 32) - 1
-
   if not isinstance(zinfo_or_arcname, zipfile.ZipInfo):
     zinfo = zipfile.ZipInfo(filename=zinfo_or_arcname)
     zinfo.compress_type = zip_file.compression
@@ -1644,43 +1994,138 @@ def ZipWriteStr(zip_file, zinfo_or_arcname, data, perms=None,
   # Use a fixed timestamp so the output is repeatable.
   zinfo.date_time = (2009, 1, 1, 0, 0, 0)
 
-  zip_file.writestr(zinfo, data)
-  zipfile.ZIP64_LIMIT = saved_zip64_limit
+  with _RaisedZip64Limit():
+    zip_file.writestr(zinfo, data)
+
+
+def _CopyFileRange(src, dst, offset, length):
+  """Copies length bytes at the given offset of src to the position of dst.
+
+  The data is copied in 1MiB chunks.
+  """
+  src.seek(offset)
+  while length > 0:
+    data = src.read(min(length, 1 << 20))
+    if not data:
+      raise ExternalError("Unexpected end of file at offset {}".format(offset))
+    dst.write(data)
+    length -= len(data)
+
+
+def _StripZip64Extra(extra):
+  """Drops the ZIP64 field from the extra data of a central directory record.
+
+  zipfile adds the field back when writing the central directory if it's
+  still needed. Python 2 would otherwise end up with two of them.
+  """
+  result = []
+  i = 0
+  while i + 4 <= len(extra):
+    header_id, size = struct.unpack("<HH", extra[i:i + 4])
+    if header_id != 1:
+      result.append(extra[i:i + 4 + size])
+    i += 4 + size
+  return b"".join(result)
+
+
+def GetZipEntryNames(zip_file):
+  """Returns the entry names of the given ZipFile, for membership tests.
+
+  ZipFile.namelist() builds a new list on each call, which makes every
+  "name in zip_file.namelist()" an O(N) copy plus an O(N) scan. This returns
+  the name-to-ZipInfo dict that zipfile maintains instead, which supports O(1)
+  lookups and stays up to date as entries are written to the archive.
+  """
+  return zip_file.NameToInfo
 
 
 def ZipDelete(zip_filename, entries):
   """Deletes entries from a ZIP file.
 
-  Since deleting entries from a ZIP file is not supported, it shells out to
-  'zip -d'.
+  Since deleting entries from a ZIP file is not supported by zipfile, it copies
+  the remaining entries as-is (without recompressing them) into a new ZIP file,
+  which then replaces the original one.
 
   Args:
     zip_filename: The name of the ZIP file.
     entries: The name of the entry, or the list of names to be deleted.
 
   Raises:
-    AssertionError: In case of non-zero return from 'zip'.
+    ExternalError: If none of the entries exists in the ZIP file.
   """
   if isinstance(entries, str):
     entries = [entries]
-  cmd = ["zip", "-d", zip_filename] + entries
-  RunAndCheckOutput(cmd)
+  to_delete = set(entries)
+
+  with zipfile.ZipFile(zip_filename) as input_zip:
+    infos = sorted(input_zip.infolist(), key=lambda info: info.header_offset)
+    if not to_delete.intersection(input_zip.NameToInfo):
+      raise ExternalError(
+          "Failed to delete {} from {}: no such entries".format(
+              entries, zip_filename))
+    for name in sorted(to_delete.difference(input_zip.NameToInfo)):
+      logger.warning("%s not found in %s", name, zip_filename)
+
+    # An entry spans from its local header to the next one, or to the start of
+    # the central directory for the last one.
+    next_offsets = [info.header_offset for info in infos[1:]]
+    next_offsets.append(input_zip.start_dir)
+
+    fd, output_filename = tempfile.mkstemp(
+        prefix="tmp", suffix=".zip", dir=os.path.dirname(zip_filename) or ".")
+    os.close(fd)
+    try:
+      output_zip = zipfile.ZipFile(output_filename, "w", allowZip64=True)
+      src = input_zip.fp
+      for info, next_offset in zip(infos, next_offsets):
+        if info.filename in to_delete:
+          continue
+
+        # Skip anything (e.g. an APK signing block) between the entry data and
+        # the next record, unless a data descriptor follows the data.
+        entry_end = next_offset
+        if not info.flag_bits & 0x08:
+          src.seek(info.header_offset)
+          fheader = struct.unpack(
+              zipfile.structFileHeader, src.read(zipfile.sizeFileHeader))
+          entry_end = (info.header_offset + zipfile.sizeFileHeader +
+                       fheader[zipfile._FH_FILENAME_LENGTH] +
+                       fheader[zipfile._FH_EXTRA_FIELD_LENGTH] +
+                       info.compress_size)
+
+        new_offset = output_zip.fp.tell()
+        _CopyFileRange(src, output_zip.fp, info.header_offset,
+                       entry_end - info.header_offset)
+        info.header_offset = new_offset
+        info.extra = _StripZip64Extra(info.extra)
+        output_zip.filelist.append(info)
+        output_zip.NameToInfo[info.filename] = info
+
+      output_zip.start_dir = output_zip.fp.tell()
+      output_zip._didModify = True
+      output_zip.comment = input_zip.comment
+      ZipClose(output_zip)
+
+      shutil.copymode(zip_filename, output_filename)
+      os.rename(output_filename, zip_filename)
+    finally:
+      if os.path.exists(output_filename):
+        os.remove(output_filename)
 
 
 def ZipClose(zip_file):
   # http://b/18015246
   # zipfile also refers to ZIP64_LIMIT during close() when it writes out the
   # central directory.
-  saved_zip64_limit = zipfile.ZIP64_LIMIT
-  zipfile.ZIP64_LIMIT = (1 << 32) - 1
-
-  zip_file.close()
-
-  zipfile.ZIP64_LIMIT = saved_zip64_limit
+  with _RaisedZip64Limit():
+    zip_file.close()
 
 
 class DeviceSpecificParams(object):
   module = None
+  # The module's hook functions (None if not defined), keyed by (module, name).
+  _functions = {}
+
   def __init__(self, **kwargs):
     """Keyword arguments to the constructor become attributes of this
     object, which is passed to all functions in the device-specific
@@ -1702,8 +2147,10 @@ class DeviceSpecificParams(object):
           if x == ".py":
             f = b
           info = imp.find_module(f, [d])
+        # Keep the loaded module on the class, so that later instances don't
+        # search for and execute it again.
+        DeviceSpecificParams.module = imp.load_module("device_specific", *info)
         logger.info("loaded device-specific extensions from %s", path)
-        self.module = imp.load_module("device_specific", *info)
       except ImportError:
         logger.info("unable to load device-specific module; assuming none")
 
@@ -1713,9 +2160,17 @@ class DeviceSpecificParams(object):
     the DeviceSpecific object itself.  If there is no module, or the
     module does not define the function, return the value of the
     'default' kwarg (which itself defaults to None)."""
-    if self.module is None or not hasattr(self.module, function_name):
+    if self.module is None:
       return kwargs.get("default")
-    return getattr(self.module, function_name)(*((self,) + args), **kwargs)
+    key = (self.module, function_name)
+    try:
+      function = self._functions[key]
+    except KeyError:
+      function = getattr(self.module, function_name, None)
+      self._functions[key] = function
+    if function is None:
+      return kwargs.get("default")
+    return function(*((self,) + args), **kwargs)
 
   def FullOTA_Assertions(self):
     """Called after emitting the block of assertions at the top of a
@@ -1791,13 +2246,38 @@ class File(object):
     self.size = len(data)
     self.compress_size = compress_size or self.size
     self.sha1 = sha1(data).hexdigest()
+    # Set by FromLocalFile(), see _GetDiskPath().
+    self.disk_path = None
+    self._disk_data = None
+    self._disk_stat = None
 
   @classmethod
   def FromLocalFile(cls, name, diskname):
-    f = open(diskname, "rb")
-    data = f.read()
-    f.close()
-    return File(name, data)
+    with open(diskname, "rb") as f:
+      data = f.read()
+      st = os.fstat(f.fileno())
+    result = cls(name, data)
+    result.disk_path = diskname
+    result._disk_data = data
+    result._disk_stat = (st.st_ino, st.st_size, st.st_mtime)
+    return result
+
+  def _GetDiskPath(self):
+    """Returns the path of a file that holds exactly 'data', or None.
+
+    That's the file FromLocalFile() read 'data' from, as long as neither 'data'
+    nor the file has been replaced or modified since. Callers can then use it
+    instead of writing 'data' out again.
+    """
+    if self.disk_path is None or self.data is not self._disk_data:
+      return None
+    try:
+      st = os.stat(self.disk_path)
+    except OSError:
+      return None
+    if (st.st_ino, st.st_size, st.st_mtime) != self._disk_stat:
+      return None
+    return self.disk_path
 
   def WriteToTemp(self):
     t = tempfile.NamedTemporaryFile()
@@ -1806,7 +2286,13 @@ class File(object):
     return t
 
   def WriteToDir(self, d):
-    with open(os.path.join(d, self.name), "wb") as fp:
+    path = os.path.join(d, self.name)
+    # Nothing to write if that's the (unchanged) file 'data' was read from.
+    disk_path = self._GetDiskPath()
+    if (disk_path and os.path.exists(path) and
+        os.path.samefile(path, disk_path)):
+      return
+    with open(path, "wb") as fp:
       fp.write(self.data)
 
   def AddToZip(self, z, compression=None):
@@ -1815,77 +2301,125 @@ class File(object):
 
 DIFF_PROGRAM_BY_EXT = {
     ".gz" : "imgdiff",
-    ".zip" : ["imgdiff", "-z"],
-    ".jar" : ["imgdiff", "-z"],
-    ".apk" : ["imgdiff", "-z"],
+    ".zip" : ("imgdiff", "-z"),
+    ".jar" : ("imgdiff", "-z"),
+    ".apk" : ("imgdiff", "-z"),
     ".img" : "imgdiff",
     }
 
 
+def _CommunicateWithTimeout(p, timeout):
+  """Waits for the process 'p' for up to 'timeout' seconds.
+
+  Terminates the process if it's still running by then (and kills it if it
+  doesn't exit within another 5 seconds). Returns its stderr output.
+  """
+  # communicate() takes no timeout on Python 2, so wait on it in a thread.
+  errors = []
+  def run():
+    _, e = p.communicate()
+    if e:
+      errors.append(e)
+  th = threading.Thread(target=run)
+  th.start()
+  th.join(timeout=timeout)
+  if th.is_alive():
+    logger.warning("diff command timed out")
+    p.terminate()
+    th.join(5)
+    if th.is_alive():
+      p.kill()
+      th.join()
+  return "".join(errors)
+
+
 class Difference(object):
   def __init__(self, tf, sf, diff_program=None):
     self.tf = tf
     self.sf = sf
-    self.patch = None
+    self._patch = None
+    # The patch written by the diff program; it's only read into memory once
+    # 'patch' is accessed.
+    self.patch_path = None
     self.diff_program = diff_program
 
-  def ComputePatch(self):
+  @property
+  def patch(self):
+    if self._patch is None and self.patch_path:
+      with open(self.patch_path, "rb") as f:
+        self._patch = f.read()
+    return self._patch
+
+  @patch.setter
+  def patch(self, value):
+    self._patch = value
+    self.patch_path = None
+
+  def ComputePatch(self, allow_empty=False):
     """Compute the patch (as a string of data) needed to turn sf into
-    tf.  Returns the same tuple as GetPatch()."""
+    tf.  Returns the same tuple as GetPatch().
+
+    If allow_empty is True and the two files are identical, no diff program
+    is run and the patch is empty. Only callers that handle an empty patch
+    should ask for that; applypatch can't apply one."""
+    if not self._ComputePatch(allow_empty):
+      return None, None, None
+    return self.GetPatch()
+
+  def _ComputePatch(self, allow_empty=False):
+    """Computes the patch into patch_path (or 'patch' if it's empty), without
+    reading it into memory. Returns False if running the diff program
+    failed."""
 
     tf = self.tf
     sf = self.sf
 
+    if allow_empty and tf.size == sf.size and tf.sha1 == sf.sha1:
+      logger.info("%s is identical to %s; skipping diff", tf.name, sf.name)
+      self.patch = b""
+      return True
+
     if self.diff_program:
       diff_program = self.diff_program
     else:
       ext = os.path.splitext(tf.name)[1]
       diff_program = DIFF_PROGRAM_BY_EXT.get(ext, "bsdiff")
 
-    ttemp = tf.WriteToTemp()
-    stemp = sf.WriteToTemp()
+    # Files loaded from disk can be handed to the diff tool as they are.
+    tpath = tf._GetDiskPath()  # pylint: disable=protected-access
+    spath = sf._GetDiskPath()  # pylint: disable=protected-access
+    ttemp = None if tpath else tf.WriteToTemp()
+    stemp = None if spath else sf.WriteToTemp()
+    tpath = tpath or ttemp.name
+    spath = spath or stemp.name
 
     ext = os.path.splitext(tf.name)[1]
 
+    # The patch stays on disk until Cleanup(), rather than being read back
+    # into memory here.
+    patch_path = MakeTempFile(prefix="patch-")
     try:
-      ptemp = tempfile.NamedTemporaryFile()
-      if isinstance(diff_program, list):
-        cmd = copy.copy(diff_program)
+      if isinstance(diff_program, (list, tuple)):
+        cmd = list(diff_program)
       else:
         cmd = [diff_program]
-      cmd.append(stemp.name)
-      cmd.append(ttemp.name)
-      cmd.append(ptemp.name)
+      cmd.extend((spath, tpath, patch_path))
       p = Run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-      err = []
-      def run():
-        _, e = p.communicate()
-        if e:
-          err.append(e)
-      th = threading.Thread(target=run)
-      th.start()
-      th.join(timeout=300)   # 5 mins
-      if th.is_alive():
-        logger.warning("diff command timed out")
-        p.terminate()
-        th.join(5)
-        if th.is_alive():
-          p.kill()
-          th.join()
+      err = _CommunicateWithTimeout(p, 300)   # 5 mins
 
       if p.returncode != 0:
-        logger.warning("Failure running %s:\n%s\n", diff_program, "".join(err))
+        logger.warning("Failure running %s:\n%s\n", diff_program, err)
         self.patch = None
-        return None, None, None
-      diff = ptemp.read()
+        return False
     finally:
-      ptemp.close()
-      stemp.close()
-      ttemp.close()
-
-    self.patch = diff
-    return self.tf, self.sf, self.patch
+      if stemp:
+        stemp.close()
+      if ttemp:
+        ttemp.close()
 
+    self.patch = None
+    self.patch_path = patch_path
+    return True
 
   def GetPatch(self):
     """Returns a tuple of (target_file, source_file, patch_data).
@@ -1895,6 +2429,26 @@ class Difference(object):
     """
     return self.tf, self.sf, self.patch
 
+  def GetPatchSize(self):
+    """Returns the size of the patch without reading it into memory, or None
+    if there's no patch."""
+    if self._patch is None and self.patch_path:
+      return os.path.getsize(self.patch_path)
+    if self._patch is None:
+      return None
+    return len(self._patch)
+
+
+def _TimedComputePatch(d):
+  """Runs d.ComputePatch() and returns (d, elapsed seconds)."""
+  try:
+    start = time.time()
+    d._ComputePatch()  # pylint: disable=protected-access
+    return d, time.time() - start
+  except Exception:
+    logger.exception("Failed to compute diff from worker")
+    raise
+
 
 def ComputeDifferences(diffs):
   """Call ComputePatch on all the Difference objects in 'diffs'."""
@@ -1905,42 +2459,68 @@ def ComputeDifferences(diffs):
   by_size.sort(reverse=True)
   by_size = [i[1] for i in by_size]
 
-  lock = threading.Lock()
-  diff_iter = iter(by_size)   # accessed under lock
+  # The pool's task queue hands out the diffs (largest first, one at a time);
+  # results are logged from this thread only, so no extra lock is needed.
+  pool = multiprocessing.pool.ThreadPool(
+      OPTIONS.worker_threads or multiprocessing.cpu_count())
+  try:
+    for d, dur in pool.imap_unordered(_TimedComputePatch, by_size, 1):
+      tf, sf = d.tf, d.sf
+      patch_size = d.GetPatchSize()
+      if sf.name == tf.name:
+        name = tf.name
+      else:
+        name = "%s (%s)" % (tf.name, sf.name)
+      if patch_size is None:
+        logger.error("patching failed! %40s", name)
+      else:
+        logger.info(
+            "%8.2f sec %8d / %8d bytes (%6.2f%%) %s", dur, patch_size,
+            tf.size, 100.0 * patch_size / tf.size, name)
+  finally:
+    pool.terminate()
+    pool.join()
 
-  def worker():
-    try:
-      lock.acquire()
-      for d in diff_iter:
-        lock.release()
-        start = time.time()
-        d.ComputePatch()
-        dur = time.time() - start
-        lock.acquire()
-
-        tf, sf, patch = d.GetPatch()
-        if sf.name == tf.name:
-          name = tf.name
-        else:
-          name = "%s (%s)" % (tf.name, sf.name)
-        if patch is None:
-          logger.error("patching failed! %40s", name)
-        else:
-          logger.info(
-              "%8.2f sec %8d / %8d bytes (%6.2f%%) %s", dur, len(patch),
-              tf.size, 100.0 * len(patch) / tf.size, name)
-      lock.release()
-    except Exception:
-      logger.exception("Failed to compute diff from worker")
-      raise
 
-  # start worker threads; wait for them all to finish.
-  threads = [threading.Thread(target=worker)
-             for i in range(OPTIONS.worker_threads)]
-  for th in threads:
-    th.start()
-  while threads:
-    threads.pop().join()
+# Thread pools shared by the BlockImageDiff of every partition, keyed by their
+# size and created on first use by _GetDiffPool().
+_diff_pools = {}
+_diff_pools_lock = threading.Lock()
+
+
+def _GetDiffPool():
+  """Returns the thread pool that BlockImageDiff runs its workers on.
+
+  It has OPTIONS.worker_threads threads, or as many as BlockImageDiff uses by
+  default if that's unset.
+  """
+  threads = (OPTIONS.worker_threads or
+             max(multiprocessing.cpu_count() // 2, 1))
+  with _diff_pools_lock:
+    pool = _diff_pools.get(threads)
+    if pool is None:
+      pool = _diff_pools[threads] = multiprocessing.pool.ThreadPool(threads)
+    return pool
+
+
+# A 1MiB run of zeros, so that hashing a large zero range takes few update()
+# calls rather than one per 4096-byte block.
+_ZERO_BUFFER = b'\x00' * (1 << 20)
+
+# Hex SHA-1 digests of N zero blocks, keyed by N. Partitions often share the
+# same extended size.
+_zero_blocks_sha1_cache = {}
+
+
+def BrotliCompress(src, dst, quality):
+  """Compresses the file 'src' into 'dst' with brotli at the given quality.
+
+  Always runs the brotli command line tool. The Python module picks a
+  different default window and can't be given the size hint the tool sets, so
+  its output would depend on whether the module is installed.
+  """
+  RunAndCheckOutput(['brotli', '--quality={}'.format(quality),
+                     '--output={}'.format(dst), src])
 
 
 class BlockDifference(object):
@@ -1961,9 +2541,14 @@ class BlockDifference(object):
 
     b = blockimgdiff.BlockImageDiff(tgt, src, threads=OPTIONS.worker_threads,
                                     version=self.version,
-                                    disable_imgdiff=self.disable_imgdiff)
+                                    disable_imgdiff=self.disable_imgdiff,
+                                    pool=_GetDiffPool())
     self.path = os.path.join(MakeTempDir(), partition)
     b.Compute(self.path)
+    self._new_data_compressed = False
+    # Computed on first use by _TargetCareMap().
+    self._tgt_care_map_str = None
+    self._tgt_total_sha1 = None
     self._required_cache = b.max_stashed_size
     self.touched_src_ranges = b.touched_src_ranges
     self.touched_src_sha1 = b.touched_src_sha1
@@ -2017,6 +2602,17 @@ class BlockDifference(object):
     if write_verify_script:
       self.WritePostInstallVerifyScript(script)
 
+  def _TargetCareMap(self):
+    """Returns the target care_map as a raw range string, and the SHA-1 of
+    those blocks including the clobbered ones.
+
+    Both are computed once, since hashing the care_map reads the whole image
+    and both the strict and the post-install verification need them."""
+    if self._tgt_total_sha1 is None:
+      self._tgt_care_map_str = self.tgt.care_map.to_string_raw()
+      self._tgt_total_sha1 = self.tgt.TotalSha1(include_clobbered_blocks=True)
+    return self._tgt_care_map_str, self._tgt_total_sha1
+
   def WriteStrictVerifyScript(self, script):
     """Verify all the blocks in the care_map, including clobbered blocks.
 
@@ -2026,14 +2622,11 @@ class BlockDifference(object):
 
     partition = self.partition
     script.Print("Verifying %s..." % (partition,))
-    ranges = self.tgt.care_map
-    ranges_str = ranges.to_string_raw()
+    ranges_str, expected_sha1 = self._TargetCareMap()
     script.AppendExtra(
         'range_sha1(%s, "%s") == "%s" && ui_print("    Verified.") || '
         'ui_print("%s has unexpected contents.");' % (
-            self.device, ranges_str,
-            self.tgt.TotalSha1(include_clobbered_blocks=True),
-            self.partition))
+            self.device, ranges_str, expected_sha1, self.partition))
     script.AppendExtra("")
 
   def WriteVerifyScript(self, script, touched_blocks_only=False):
@@ -2064,7 +2657,9 @@ class BlockDifference(object):
               self.device, ranges_str, expected_sha1,
               self.device, partition, partition, partition))
       script.Print('Verified %s image...' % (partition,))
-      script.AppendExtra('else')
+
+      # Collect the else branch and append it to the script in one piece.
+      else_branch = ['else']
 
       if self.version >= 4:
 
@@ -2075,14 +2670,14 @@ class BlockDifference(object):
         # this check fails, give an explicit log message about the partition
         # having been remounted R/W (the most likely explanation).
         if self.check_first_block:
-          script.AppendExtra('check_first_block(%s);' % (self.device,))
+          else_branch.append('check_first_block(%s);' % (self.device,))
 
         # If version >= 4, try block recovery before abort update
         if partition == "system":
           code = ErrorCode.SYSTEM_RECOVER_FAILURE
         else:
           code = ErrorCode.VENDOR_RECOVER_FAILURE
-        script.AppendExtra((
+        else_branch.append((
             'ifelse (block_image_recover({device}, "{ranges}") && '
             'block_image_verify({device}, '
             'package_extract_file("{partition}.transfer.list"), '
@@ -2102,20 +2697,20 @@ class BlockDifference(object):
           code = ErrorCode.SYSTEM_VERIFICATION_FAILURE
         else:
           code = ErrorCode.VENDOR_VERIFICATION_FAILURE
-        script.AppendExtra((
+        else_branch.append((
             'abort("E%d: %s partition has unexpected contents");\n'
             'endif;') % (code, partition))
 
+      script.AppendExtra('\n'.join(else_branch))
+
   def WritePostInstallVerifyScript(self, script):
     partition = self.partition
     script.Print('Verifying qassa %s image...' % (partition,))
     # Unlike pre-install verification, clobbered_blocks should not be ignored.
-    ranges = self.tgt.care_map
-    ranges_str = ranges.to_string_raw()
+    ranges_str, expected_sha1 = self._TargetCareMap()
     script.AppendExtra(
         'if range_sha1(%s, "%s") == "%s" then' % (
-            self.device, ranges_str,
-            self.tgt.TotalSha1(include_clobbered_blocks=True)))
+            self.device, ranges_str, expected_sha1))
 
     # Bug: 20881595
     # Verify that extended blocks are really zeroed out.
@@ -2149,6 +2744,16 @@ class BlockDifference(object):
         'update");\n'
         'endif;' % (code, partition))
 
+  def CompressNewData(self):
+    """Compresses the new.dat of a full update into new.dat.br, once."""
+    assert not self.src
+    if self._new_data_compressed:
+      return
+    print("Compressing {}.new.dat with brotli".format(self.partition))
+    BrotliCompress('{}.new.dat'.format(self.path),
+                   '{}.new.dat.br'.format(self.path), quality=6)
+    self._new_data_compressed = True
+
   def _WriteUpdate(self, script, output_zip):
     ZipWrite(output_zip,
              '{}.transfer.list'.format(self.path),
@@ -2163,11 +2768,7 @@ class BlockDifference(object):
     #   decompression_time: 15s  | 25s                | 25s
 
     if not self.src:
-      brotli_cmd = ['brotli', '--quality=6',
-                    '--output={}.new.dat.br'.format(self.path),
-                    '{}.new.dat'.format(self.path)]
-      print("Compressing {}.new.dat with brotli".format(self.partition))
-      RunAndCheckOutput(brotli_cmd)
+      self.CompressNewData()
 
       new_data_name = '{}.new.dat.br'.format(self.partition)
       ZipWrite(output_zip,
@@ -2198,22 +2799,23 @@ class BlockDifference(object):
     script.AppendExtra(script.WordWrap(call))
 
   def _HashBlocks(self, source, ranges): # pylint: disable=no-self-use
-    data = source.ReadRangeSet(ranges)
-    ctx = sha1()
-
-    for p in data:
-      ctx.update(p)
-
-    return ctx.hexdigest()
+    # Image.RangeSha1() streams the data (FileImage in large chunks) instead of
+    # building the list that ReadRangeSet() returns.
+    return source.RangeSha1(ranges)
 
   def _HashZeroBlocks(self, num_blocks): # pylint: disable=no-self-use
     """Return the hash value for all zero blocks."""
-    zero_block = '\x00' * 4096
-    ctx = sha1()
-    for _ in range(num_blocks):
-      ctx.update(zero_block)
-
-    return ctx.hexdigest()
+    digest = _zero_blocks_sha1_cache.get(num_blocks)
+    if digest is None:
+      ctx = sha1()
+      full, rem = divmod(num_blocks * 4096, len(_ZERO_BUFFER))
+      for _ in range(full):
+        ctx.update(_ZERO_BUFFER)
+      if rem:
+        ctx.update(memoryview(_ZERO_BUFFER)[:rem])
+      digest = ctx.hexdigest()
+      _zero_blocks_sha1_cache[num_blocks] = digest
+    return digest
 
 
 # This is just a little wrapper around FileSystemDiff.
@@ -2272,16 +2874,13 @@ def ParseCertificate(data):
   Returns:
     The decoded certificate bytes.
   """
-  cert_buffer = []
-  save = False
-  for line in data.split("\n"):
-    if "--END CERTIFICATE--" in line:
-      break
-    if save:
-      cert_buffer.append(line)
-    if "--BEGIN CERTIFICATE--" in line:
-      save = True
-  cert = base64.b64decode("".join(cert_buffer))
+  # Take the lines strictly between the BEGIN and END lines; b64decode() skips
+  # the newlines in between.
+  body = data.partition("--BEGIN CERTIFICATE--")[2].partition("\n")[2]
+  body, end, _ = body.partition("--END CERTIFICATE--")
+  if end:
+    body = body.rpartition("\n")[0]
+  cert = base64.b64decode(body)
   return cert
 
 
@@ -2324,6 +2923,34 @@ def ExtractAvbPublicKey(key):
   return output
 
 
+# install-recovery.sh templates for MakeRecoveryPatch(): flashing a full
+# recovery image, and patching recovery from boot.
+_RECOVERY_FULL_SCRIPT = string.Template("""#!/system/bin/sh
+if ! applypatch --check ${type}:${device}:${size}:${sha1}; then
+  applypatch \\
+          --flash /system/etc/recovery.img \\
+          --target ${type}:${device}:${size}:${sha1} && \\
+      log -t recovery "Installing new recovery image: succeeded" || \\
+      log -t recovery "Installing new recovery image: failed"
+else
+  log -t recovery "Recovery image already installed"
+fi
+""")
+
+_RECOVERY_FROM_BOOT_SCRIPT = string.Template("""#!/system/bin/sh
+if ! applypatch --check ${recovery_type}:${recovery_device}:${recovery_size}:${recovery_sha1}; then
+  applypatch ${bonus_args} \\
+          --patch /system/recovery-from-boot.p \\
+          --source ${boot_type}:${boot_device}:${boot_size}:${boot_sha1} \\
+          --target ${recovery_type}:${recovery_device}:${recovery_size}:${recovery_sha1} && \\
+      log -t recovery "Installing new recovery image: succeeded" || \\
+      log -t recovery "Installing new recovery image: failed"
+else
+  log -t recovery "Recovery image already installed"
+fi
+""")
+
+
 def MakeRecoveryPatch(input_dir, output_sink, recovery_img, boot_img,
                       info_dict=None):
   """Generates the recovery-from-boot patch and writes the script to output.
@@ -2382,41 +3009,22 @@ def MakeRecoveryPatch(input_dir, output_sink, recovery_img, boot_img,
     return
 
   if full_recovery_image:
-    sh = """#!/system/bin/sh
-if ! applypatch --check %(type)s:%(device)s:%(size)d:%(sha1)s; then
-  applypatch \\
-          --flash /system/etc/recovery.img \\
-          --target %(type)s:%(device)s:%(size)d:%(sha1)s && \\
-      log -t recovery "Installing new recovery image: succeeded" || \\
-      log -t recovery "Installing new recovery image: failed"
-else
-  log -t recovery "Recovery image already installed"
-fi
-""" % {'type': recovery_type,
-       'device': recovery_device,
-       'sha1': recovery_img.sha1,
-       'size': recovery_img.size}
+    sh = _RECOVERY_FULL_SCRIPT.substitute(
+        type=recovery_type,
+        device=recovery_device,
+        sha1=recovery_img.sha1,
+        size=recovery_img.size)
   else:
-    sh = """#!/system/bin/sh
-if ! applypatch --check %(recovery_type)s:%(recovery_device)s:%(recovery_size)d:%(recovery_sha1)s; then
-  applypatch %(bonus_args)s \\
-          --patch /system/recovery-from-boot.p \\
-          --source %(boot_type)s:%(boot_device)s:%(boot_size)d:%(boot_sha1)s \\
-          --target %(recovery_type)s:%(recovery_device)s:%(recovery_size)d:%(recovery_sha1)s && \\
-      log -t recovery "Installing new recovery image: succeeded" || \\
-      log -t recovery "Installing new recovery image: failed"
-else
-  log -t recovery "Recovery image already installed"
-fi
-""" % {'boot_size': boot_img.size,
-       'boot_sha1': boot_img.sha1,
-       'recovery_size': recovery_img.size,
-       'recovery_sha1': recovery_img.sha1,
-       'boot_type': boot_type,
-       'boot_device': boot_device,
-       'recovery_type': recovery_type,
-       'recovery_device': recovery_device,
-       'bonus_args': bonus_args}
+    sh = _RECOVERY_FROM_BOOT_SCRIPT.substitute(
+        boot_size=boot_img.size,
+        boot_sha1=boot_img.sha1,
+        recovery_size=recovery_img.size,
+        recovery_sha1=recovery_img.sha1,
+        boot_type=boot_type,
+        boot_device=boot_device,
+        recovery_type=recovery_type,
+        recovery_device=recovery_device,
+        bonus_args=bonus_args)
 
   # The install script location moved from /system/etc to /system/bin
   # in the L release.
@@ -2461,6 +3069,17 @@ class DynamicGroupUpdate(object):
     self.tgt_size = tgt_size
 
 
+# What a dynamic partition group update does, see
+# DynamicPartitionsDifference._ClassifyGroupUpdate().
+_GROUP_REMOVE, _GROUP_SHRINK, _GROUP_ADD, _GROUP_GROW = range(4)
+
+# The phases of DynamicPartitionsDifference, see its _GetPlan().
+_DynamicPartitionsPlan = collections.namedtuple(
+    "_DynamicPartitionsPlan",
+    ["resize", "remove", "move", "shrink", "add", "grow",
+     "patch_after_update", "shrink_groups", "grow_groups"])
+
+
 class DynamicPartitionsDifference(object):
   def __init__(self, info_dict, block_diffs, progress_dict=None,
                source_info_dict=None, build_without_vendor=False):
@@ -2480,49 +3099,51 @@ class DynamicPartitionsDifference(object):
              collections.Counter(e.partition for e in block_diffs).items()
              if count > 1])
 
-    self._partition_updates = collections.OrderedDict()
+    partition_updates = self._partition_updates = collections.OrderedDict()
 
     for p, block_diff in block_diff_dict.items():
-      self._partition_updates[p] = DynamicPartitionUpdate()
-      self._partition_updates[p].block_difference = block_diff
+      partition_updates[p] = DynamicPartitionUpdate(
+          block_difference=block_diff)
 
     for p, progress in progress_dict.items():
-      if p in self._partition_updates:
-        self._partition_updates[p].progress = progress
+      if p in partition_updates:
+        partition_updates[p].progress = progress
 
-    tgt_groups = shlex.split(info_dict.get(
-        "super_partition_groups", "").strip())
-    src_groups = shlex.split(source_info_dict.get(
-        "super_partition_groups", "").strip())
+    tgt_groups = info_dict.get("super_partition_groups", "").split()
+    src_groups = source_info_dict.get("super_partition_groups", "").split()
 
     for g in tgt_groups:
-      for p in shlex.split(info_dict.get(
-          "super_%s_partition_list" % g, "").strip()):
-        assert p in self._partition_updates, \
+      for p in info_dict.get("super_%s_partition_list" % g, "").split():
+        assert p in partition_updates, \
             "{} is in target super_{}_partition_list but no BlockDifference " \
             "object is provided.".format(p, g)
-        self._partition_updates[p].tgt_group = g
+        partition_updates[p].tgt_group = g
 
     for g in src_groups:
-      for p in shlex.split(source_info_dict.get(
-          "super_%s_partition_list" % g, "").strip()):
-        assert p in self._partition_updates, \
+      for p in source_info_dict.get("super_%s_partition_list" % g, "").split():
+        assert p in partition_updates, \
             "{} is in source super_{}_partition_list but no BlockDifference " \
             "object is provided.".format(p, g)
-        self._partition_updates[p].src_group = g
-
-    target_dynamic_partitions = set(shlex.split(info_dict.get(
-        "dynamic_partition_list", "").strip()))
-    block_diffs_with_target = set(p for p, u in self._partition_updates.items()
-                                  if u.tgt_size)
+        partition_updates[p].src_group = g
+
+    # Sort the partitions by whether they have a target and a source image in
+    # one walk.
+    block_diffs_with_target = set()
+    block_diffs_with_source = set()
+    for p, u in partition_updates.items():
+      if u.tgt_size:
+        block_diffs_with_target.add(p)
+      if u.src_size:
+        block_diffs_with_source.add(p)
+
+    target_dynamic_partitions = set(info_dict.get(
+        "dynamic_partition_list", "").split())
     assert block_diffs_with_target == target_dynamic_partitions, \
         "Target Dynamic partitions: {}, BlockDifference with target: {}".format(
             list(target_dynamic_partitions), list(block_diffs_with_target))
 
-    source_dynamic_partitions = set(shlex.split(source_info_dict.get(
-        "dynamic_partition_list", "").strip()))
-    block_diffs_with_source = set(p for p, u in self._partition_updates.items()
-                                  if u.src_size)
+    source_dynamic_partitions = set(source_info_dict.get(
+        "dynamic_partition_list", "").split())
     assert block_diffs_with_source == source_dynamic_partitions, \
         "Source Dynamic partitions: {}, BlockDifference with source: {}".format(
             list(source_dynamic_partitions), list(block_diffs_with_source))
@@ -2531,33 +3152,36 @@ class DynamicPartitionsDifference(object):
       logger.info("Updating dynamic partitions %s",
                   self._partition_updates.keys())
 
-    self._group_updates = collections.OrderedDict()
+    group_updates = self._group_updates = collections.OrderedDict()
 
     for g in tgt_groups:
-      self._group_updates[g] = DynamicGroupUpdate()
-      self._group_updates[g].tgt_size = int(info_dict.get(
-          "super_%s_group_size" % g, "0").strip())
+      group_updates[g] = DynamicGroupUpdate(tgt_size=int(info_dict.get(
+          "super_%s_group_size" % g, "0").strip()))
 
     for g in src_groups:
-      if g not in self._group_updates:
-        self._group_updates[g] = DynamicGroupUpdate()
-      self._group_updates[g].src_size = int(source_info_dict.get(
+      u = group_updates.get(g)
+      if u is None:
+        u = group_updates[g] = DynamicGroupUpdate()
+      u.src_size = int(source_info_dict.get(
           "super_%s_group_size" % g, "0").strip())
 
+    self._plan = None
     self._Compute()
 
   def WriteScript(self, script, output_zip, write_verify_script=False):
+    self._CompressNewData()
+
+    plan = self._GetPlan()
+
     script.Comment('--- Start patching dynamic partitions ---')
-    for p, u in self._partition_updates.items():
-      if u.src_size and u.tgt_size and u.src_size > u.tgt_size:
-        script.Comment('Patch partition %s' % p)
-        u.block_difference.WriteScript(script, output_zip, progress=u.progress,
-                                       write_verify_script=False)
+    for p, u, _, _ in plan.shrink:
+      script.Comment('Patch partition %s' % p)
+      u.block_difference.WriteScript(script, output_zip, progress=u.progress,
+                                     write_verify_script=False)
 
     op_list_path = MakeTempFile()
     with open(op_list_path, 'w') as f:
-      for line in self._op_list:
-        f.write('{}\n'.format(line))
+      f.write(''.join(line + '\n' for line in self._op_list))
 
     ZipWrite(output_zip, op_list_path, "dynamic_partitions_op_list")
 
@@ -2566,90 +3190,160 @@ class DynamicPartitionsDifference(object):
                        'package_extract_file("dynamic_partitions_op_list")));')
 
     if write_verify_script:
-      for p, u in self._partition_updates.items():
-        if u.src_size and u.tgt_size and u.src_size > u.tgt_size:
-          u.block_difference.WritePostInstallVerifyScript(script)
-          script.AppendExtra('unmap_partition("%s");' % p) # ignore errors
+      for p, u, _, _ in plan.shrink:
+        u.block_difference.WritePostInstallVerifyScript(script)
+        script.AppendExtra('unmap_partition("%s");' % p) # ignore errors
 
-    for p, u in self._partition_updates.items():
-      if u.tgt_size and u.src_size <= u.tgt_size:
-        script.Comment('Patch partition %s' % p)
-        u.block_difference.WriteScript(script, output_zip, progress=u.progress,
-                                       write_verify_script=write_verify_script)
-        if write_verify_script:
-          script.AppendExtra('unmap_partition("%s");' % p) # ignore errors
+    for p, u in plan.patch_after_update:
+      script.Comment('Patch partition %s' % p)
+      u.block_difference.WriteScript(script, output_zip, progress=u.progress,
+                                     write_verify_script=write_verify_script)
+      if write_verify_script:
+        script.AppendExtra('unmap_partition("%s");' % p) # ignore errors
 
     script.Comment('--- End patching dynamic partitions ---')
 
-  def _Compute(self):
-    self._op_list = list()
+  def _CompressNewData(self):
+    """Compresses the new.dat of all full partition updates in parallel.
+
+    Each compression runs in the brotli tool, so a thread per partition is
+    enough to overlap them. BlockDifference._WriteUpdate() then finds its
+    new.dat.br already in place.
+    """
+    full_updates = [d for d in (u.block_difference
+                                for u in self._partition_updates.values())
+                    if isinstance(d, BlockDifference) and not d.src]
+    if len(full_updates) < 2:
+      return
 
-    def append(line):
-      self._op_list.append(line)
+    pool = multiprocessing.pool.ThreadPool(
+        min(len(full_updates), multiprocessing.cpu_count()))
+    try:
+      pool.map(BlockDifference.CompressNewData, full_updates)
+    finally:
+      pool.terminate()
+      pool.join()
+
+  def _GetPlan(self):
+    """Returns the partition and group updates sorted into their phases.
+
+    The plan is computed on first use, in a single pass over the updates that
+    reads each (computed) size and group once. A partition can be in several
+    lists; each list keeps the update order. _Compute() and WriteScript() both
+    work from it.
+    """
+    if self._plan is not None:
+      return self._plan
+
+    plan = _DynamicPartitionsPlan(
+        resize=[], remove=[], move=[], shrink=[], add=[], grow=[],
+        patch_after_update=[], shrink_groups=[], grow_groups=[])
+    for p, u in self._partition_updates.items():
+      src_group, tgt_group = u.src_group, u.tgt_group
+      src_size, tgt_size = u.src_size, u.tgt_size
+      # Only used for system-only builds, which just resize every partition.
+      plan.resize.append((p, tgt_size))
+      if src_group and not tgt_group:
+        plan.remove.append(p)
+      if src_group and tgt_group and src_group != tgt_group:
+        plan.move.append((p, src_group, tgt_group))
+      if src_size and tgt_size and src_size > tgt_size:
+        plan.shrink.append((p, u, src_size, tgt_size))
+      if tgt_group and not src_group:
+        plan.add.append((p, tgt_group))
+      if tgt_size and src_size < tgt_size:
+        plan.grow.append((p, src_size, tgt_size))
+      if tgt_size and src_size <= tgt_size:
+        plan.patch_after_update.append((p, u))
+
+    for g, u in self._group_updates.items():
+      src_size, tgt_size = u.src_size, u.tgt_size
+      action = self._ClassifyGroupUpdate(src_size, tgt_size)
+      if action in (_GROUP_REMOVE, _GROUP_SHRINK):
+        plan.shrink_groups.append((g, action, src_size, tgt_size))
+      elif action in (_GROUP_ADD, _GROUP_GROW):
+        plan.grow_groups.append((g, action, src_size, tgt_size))
 
-    def comment(line):
-      self._op_list.append("# %s" % line)
+    self._plan = plan
+    return plan
+
+  @staticmethod
+  def _ClassifyGroupUpdate(src_size, tgt_size):
+    """Returns the _GROUP_* action for a group's sizes, or None if unchanged.
+
+    A size of None means the group doesn't exist on that side.
+    """
+    if src_size is None:
+      return None if tgt_size is None else _GROUP_ADD
+    if tgt_size is None:
+      return _GROUP_REMOVE
+    if src_size > tgt_size:
+      return _GROUP_SHRINK
+    if src_size < tgt_size:
+      return _GROUP_GROW
+    return None
+
+  def _Compute(self):
+    self._op_list = []
+    append = self._op_list.append
+    extend = self._op_list.extend
+    # Each phase emits a (comment, op) pair per partition; flatten the pairs
+    # straight into the op list.
+    pairs = itertools.chain.from_iterable
 
     if self._build_without_vendor:
-      comment('System-only build, keep original vendor partition')
+      append('# System-only build, keep original vendor partition')
       # When building without vendor, we do not want to override
       # any partition already existing. In this case, we can only
       # resize, but not remove / create / re-create any other
       # partition.
-      for p, u in self._partition_updates.items():
-        comment('Resize partition %s to %s' % (p, u.tgt_size))
-        append('resize %s %s' % (p, u.tgt_size))
+      extend(pairs(('# Resize partition %s to %s' % (p, tgt_size),
+                    'resize %s %s' % (p, tgt_size))
+                   for p, tgt_size in self._GetPlan().resize))
       return
 
     if self._remove_all_before_apply:
-      comment('Remove all existing dynamic partitions and groups before '
-              'applying full OTA')
+      append('# Remove all existing dynamic partitions and groups before '
+             'applying full OTA')
       append('remove_all_groups')
 
-    for p, u in self._partition_updates.items():
-      if u.src_group and not u.tgt_group:
-        append('remove %s' % p)
+    plan = self._GetPlan()
 
-    for p, u in self._partition_updates.items():
-      if u.src_group and u.tgt_group and u.src_group != u.tgt_group:
-        comment('Move partition %s from %s to default' % (p, u.src_group))
-        append('move %s default' % p)
+    extend('remove ' + p for p in plan.remove)
 
-    for p, u in self._partition_updates.items():
-      if u.src_size and u.tgt_size and u.src_size > u.tgt_size:
-        comment('Shrink partition %s from %d to %d' %
-                (p, u.src_size, u.tgt_size))
-        append('resize %s %s' % (p, u.tgt_size))
+    extend(pairs(('# Move partition %s from %s to default' % (p, src_group),
+                  'move ' + p + ' default')
+                 for p, src_group, _ in plan.move))
 
-    for g, u in self._group_updates.items():
-      if u.src_size is not None and u.tgt_size is None:
-        append('remove_group %s' % g)
-      if (u.src_size is not None and u.tgt_size is not None and
-          u.src_size > u.tgt_size):
-        comment('Shrink group %s from %d to %d' % (g, u.src_size, u.tgt_size))
-        append('resize_group %s %d' % (g, u.tgt_size))
+    extend(pairs(('# Shrink partition %s from %d to %d' % (p, src_size,
+                                                          tgt_size),
+                  'resize %s %s' % (p, tgt_size))
+                 for p, _, src_size, tgt_size in plan.shrink))
 
-    for g, u in self._group_updates.items():
-      if u.src_size is None and u.tgt_size is not None:
-        comment('Add group %s with maximum size %d' % (g, u.tgt_size))
-        append('add_group %s %d' % (g, u.tgt_size))
-      if (u.src_size is not None and u.tgt_size is not None and
-          u.src_size < u.tgt_size):
-        comment('Grow group %s from %d to %d' % (g, u.src_size, u.tgt_size))
-        append('resize_group %s %d' % (g, u.tgt_size))
+    for g, action, src_size, tgt_size in plan.shrink_groups:
+      if action == _GROUP_REMOVE:
+        append('remove_group ' + g)
+      else:
+        append('# Shrink group %s from %d to %d' % (g, src_size, tgt_size))
+        append('resize_group %s %d' % (g, tgt_size))
 
-    for p, u in self._partition_updates.items():
-      if u.tgt_group and not u.src_group:
-        comment('Add partition %s to group %s' % (p, u.tgt_group))
-        append('add %s %s' % (p, u.tgt_group))
+    for g, action, src_size, tgt_size in plan.grow_groups:
+      if action == _GROUP_ADD:
+        append('# Add group %s with maximum size %d' % (g, tgt_size))
+        append('add_group %s %d' % (g, tgt_size))
+      else:
+        append('# Grow group %s from %d to %d' % (g, src_size, tgt_size))
+        append('resize_group %s %d' % (g, tgt_size))
 
-    for p, u in self._partition_updates.items():
-      if u.tgt_size and u.src_size < u.tgt_size:
-        comment('Grow partition %s from %d to %d' % (p, u.src_size, u.tgt_size))
-        append('resize %s %d' % (p, u.tgt_size))
+    extend(pairs(('# Add partition %s to group %s' % (p, tgt_group),
+                  'add %s %s' % (p, tgt_group))
+                 for p, tgt_group in plan.add))
 
-    for p, u in self._partition_updates.items():
-      if u.src_group and u.tgt_group and u.src_group != u.tgt_group:
-        comment('Move partition %s from default to %s' %
-                (p, u.tgt_group))
-        append('move %s %s' % (p, u.tgt_group))
+    extend(pairs(('# Grow partition %s from %d to %d' % (p, src_size,
+                                                        tgt_size),
+                  'resize %s %d' % (p, tgt_size))
+                 for p, src_size, tgt_size in plan.grow))
+
+    extend(pairs(('# Move partition %s from default to %s' % (p, tgt_group),
+                  'move %s %s' % (p, tgt_group))
+                 for p, _, tgt_group in plan.move))
@@ -769,7 +769,7 @@ def AddCompatibilityArchiveIfTrebleEnabled(target_zip, output_zip, target_info,
     for file_name in compatibility_files:
       target_file_name = "META/" + file_name
 
-      if target_file_name in target_zip.namelist():
+      if target_file_name in common.GetZipEntryNames(target_zip):
         data = target_zip.read(target_file_name)
         common.ZipWriteStr(compatibility_archive_zip, file_name, data)
 
@@ -1331,7 +1331,7 @@ class PropertyFiles(object):
     for entry in self.required:
       tokens.append(ComputeEntryOffsetSize(entry))
     for entry in self.optional:
-      if entry in zip_file.namelist():
+      if entry in common.GetZipEntryNames(zip_file):
         tokens.append(ComputeEntryOffsetSize(entry))
 
     # 'META-INF/com/android/metadata' is required. We don't know its actual
@@ -2159,7 +2159,7 @@ def WriteABOTAPackageWithBrilloScript(target_file, output_file,
   if (target_info.get("verity") == "true" or
       target_info.get("avb_enable") == "true"):
     care_map_list = [x for x in ["care_map.pb", "care_map.txt"] if
-                     "META/" + x in target_zip.namelist()]
+                     "META/" + x in common.GetZipEntryNames(target_zip)]
 
     # Adds care_map if either the protobuf format or the plain text one exists.
     if care_map_list:
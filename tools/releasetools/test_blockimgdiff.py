@@ -309,3 +309,30 @@ class FileImageTest(ReleaseToolsTestCase):
   def test_read_all(self):
     data = b''.join(self.file.ReadRangeSet(self.file.care_map))
     self.assertEqual(self.data, data)
+
+  def test_RangeSha1_largeRanges(self):
+    # Spans multiple hashing chunks.
+    data = os.urandom(4096 * 600)
+    file_path = common.MakeTempFile()
+    with open(file_path, 'wb') as f:
+      f.write(data)
+    image = FileImage(file_path)
+
+    self.assertEqual(sha1(data).hexdigest(), image.TotalSha1())
+    rs = RangeSet([1, 300, 310, 580])
+    expected_data = data[4096:300 * 4096] + data[310 * 4096:580 * 4096]
+    self.assertEqual(sha1(expected_data).hexdigest(), image.RangeSha1(rs))
+
+  def test_fileMap_withHoles(self):
+    file_path = common.MakeTempFile()
+    with open(file_path, 'wb') as f:
+      f.write(b'\x01' * 4096 + b'\0' * 4096)
+      f.seek(4096 * 300 + 100)
+      f.write(b'\x02')
+      f.truncate(4096 * 1000)
+    image = FileImage(file_path)
+
+    self.assertEqual(RangeSet("0 300"), image.file_map["__NONZERO"])
+    self.assertEqual(RangeSet("1-299 301-999"), image.file_map["__ZERO"])
+    with open(file_path, 'rb') as f:
+      self.assertEqual(sha1(f.read()).hexdigest(), image.TotalSha1())
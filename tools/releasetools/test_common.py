@@ -15,7 +15,9 @@
 #
 
 import copy
+import gzip
 import os
+import stat
 import subprocess
 import tempfile
 import time
@@ -366,6 +368,27 @@ class CommonZipTest(test_utils.ReleaseToolsTestCase):
     finally:
       os.remove(zip_file.name)
 
+  def test_ZipDelete_keepsRemainingEntries(self):
+    zip_file = common.MakeTempFile(suffix='.zip')
+    contents = {
+        'Test1': os.urandom(1024),
+        'Test2': b'abc' * 4096,
+        'Test3': os.urandom(8192),
+    }
+    with zipfile.ZipFile(zip_file, 'w') as output_zip:
+      for name in sorted(contents):
+        common.ZipWriteStr(output_zip, name, contents[name],
+                           compress_type=zipfile.ZIP_DEFLATED)
+      output_zip.comment = b'comment'
+
+    common.ZipDelete(zip_file, 'Test1')
+    with zipfile.ZipFile(zip_file, 'r') as check_zip:
+      self.assertIsNone(check_zip.testzip())
+      self.assertEqual(['Test2', 'Test3'], check_zip.namelist())
+      self.assertEqual(contents['Test2'], check_zip.read('Test2'))
+      self.assertEqual(contents['Test3'], check_zip.read('Test3'))
+      self.assertEqual(b'comment', check_zip.comment)
+
   @staticmethod
   def _test_UnzipTemp_createZipFile():
     zip_file = common.MakeTempFile(suffix='.zip')
@@ -450,6 +473,58 @@ class CommonZipTest(test_utils.ReleaseToolsTestCase):
     self.assertFalse(os.path.exists(os.path.join(unzipped_dir, 'Bar4')))
     self.assertFalse(os.path.exists(os.path.join(unzipped_dir, 'Dir5/Baz5')))
 
+  def test_UnzipToDir_preservesPermsAndSymlinks(self):
+    zip_file = common.MakeTempFile(suffix='.zip')
+    with zipfile.ZipFile(zip_file, 'w') as output_zip:
+      common.ZipWriteStr(output_zip, 'bin/tool', 'tool', perms=0o755)
+      common.ZipWriteStr(output_zip, 'etc/file', 'file', perms=0o644)
+      zinfo = zipfile.ZipInfo('etc/link')
+      zinfo.external_attr = (0o120777) << 16
+      output_zip.writestr(zinfo, 'file')
+
+    unzipped_dir = common.MakeTempDir()
+    common.UnzipToDir(zip_file, unzipped_dir)
+    self.assertEqual(
+        0o755, os.stat(os.path.join(unzipped_dir, 'bin/tool')).st_mode & 0o777)
+    self.assertEqual(
+        0o644, os.stat(os.path.join(unzipped_dir, 'etc/file')).st_mode & 0o777)
+    link = os.path.join(unzipped_dir, 'etc/link')
+    self.assertTrue(os.path.islink(link))
+    self.assertEqual('file', os.readlink(link))
+
+    # Re-extracting on top of the existing files should overwrite them.
+    common.UnzipToDir(zip_file, unzipped_dir, ['etc/*'])
+    self.assertEqual('file', os.readlink(link))
+
+  def test_UnzipToDir_overReadOnlyFile(self):
+    zip_file = common.MakeTempFile(suffix='.zip')
+    info = zipfile.ZipInfo('Test1', (2009, 1, 1, 0, 0, 0))
+    info.external_attr = 0o100444 << 16
+    with zipfile.ZipFile(zip_file, 'w') as output_zip:
+      output_zip.writestr(info, b'new')
+
+    unzipped_dir = common.MakeTempDir()
+    entry = os.path.join(unzipped_dir, 'Test1')
+    with open(entry, 'wb') as f:
+      f.write(b'old')
+    os.chmod(entry, 0o444)
+    # A hard link to the existing file must keep the old content.
+    link = os.path.join(unzipped_dir, 'Link')
+    os.link(entry, link)
+
+    common.UnzipToDir(zip_file, unzipped_dir)
+    # Extracting again replaces the now read-only extracted file.
+    common.UnzipToDir(zip_file, unzipped_dir)
+
+    with open(entry, 'rb') as f:
+      self.assertEqual(b'new', f.read())
+    with open(link, 'rb') as f:
+      self.assertEqual(b'old', f.read())
+    self.assertEqual(0o444, stat.S_IMODE(os.stat(entry).st_mode))
+    self.assertEqual(
+        time.mktime((2009, 1, 1, 0, 0, 0, 0, 0, -1)),
+        os.stat(entry).st_mtime)
+
 
 class CommonApkUtilsTest(test_utils.ReleaseToolsTestCase):
   """Tests the APK utils related functions."""
@@ -651,11 +726,27 @@ class CommonUtilsTest(test_utils.ReleaseToolsTestCase):
 
   def test_GetSparseImage_missingImageFile(self):
     self.assertRaises(
-        AssertionError, common.GetSparseImage, 'system2', self.testdata_dir,
-        None, False)
+        common.ExternalError, common.GetSparseImage, 'system2',
+        self.testdata_dir, None, False)
+    self.assertRaises(
+        common.ExternalError, common.GetSparseImage, 'unknown',
+        self.testdata_dir, None, False)
+
+  def test_GetNonSparseImage_missingImageFile(self):
+    tmpdir = common.MakeTempDir()
+    os.mkdir(os.path.join(tmpdir, 'IMAGES'))
+    with open(os.path.join(tmpdir, 'IMAGES', 'system.map'), 'w') as f:
+      f.write('/system/file1 0-7\n')
+    self.assertRaises(
+        common.ExternalError, common.GetNonSparseImage, 'system', tmpdir)
+
+  def test_GetNonSparseImage_missingBlockMapFile(self):
+    tmpdir = common.MakeTempDir()
+    os.mkdir(os.path.join(tmpdir, 'IMAGES'))
+    with open(os.path.join(tmpdir, 'IMAGES', 'system.img'), 'wb') as f:
+      f.write(os.urandom(4096 * 8))
     self.assertRaises(
-        AssertionError, common.GetSparseImage, 'unknown', self.testdata_dir,
-        None, False)
+        common.ExternalError, common.GetNonSparseImage, 'system', tmpdir)
 
   def test_GetSparseImage_missingBlockMapFile(self):
     target_files = common.MakeTempFile(prefix='target_files-', suffix='.zip')
@@ -672,8 +763,8 @@ class CommonUtilsTest(test_utils.ReleaseToolsTestCase):
     tempdir = common.UnzipTemp(target_files)
     with zipfile.ZipFile(target_files, 'r') as input_zip:
       self.assertRaises(
-          AssertionError, common.GetSparseImage, 'system', tempdir, input_zip,
-          False)
+          common.ExternalError, common.GetSparseImage, 'system', tempdir,
+          input_zip, False)
 
   def test_GetSparseImage_sharedBlocks_notAllowed(self):
     """Tests the case of having overlapping blocks but disallowed."""
@@ -881,6 +972,103 @@ class CommonUtilsTest(test_utils.ReleaseToolsTestCase):
         common.ExternalError, common.GetAvbChainedPartitionArg, 'system',
         info_dict)
 
+  def test_Gunzip(self):
+    contents = os.urandom(3 * MiB)
+    input_file = common.MakeTempFile(suffix='.gz')
+    with gzip.open(input_file, 'wb') as f:
+      f.write(contents)
+
+    output_file = common.MakeTempFile()
+    common.Gunzip(input_file, output_file)
+    with open(output_file, 'rb') as f:
+      self.assertEqual(contents, f.read())
+
+  def test_LoadDictionaryFromText(self):
+    data = '\n'.join([
+        '# comment=ignored',
+        '  ro.build.id = ABC  ',
+        'ro.product.name=foo=bar',
+        '',
+        'no_equal_sign',
+        '\tkey=\r',
+    ])
+    self.assertDictEqual(
+        {
+            'ro.build.id ': ' ABC',
+            'ro.product.name': 'foo=bar',
+            'key': '',
+        },
+        common.LoadDictionaryFromText(data))
+    self.assertDictEqual(
+        common.LoadDictionaryFromText(data),
+        common.LoadDictionaryFromLines(data.split('\n')))
+
+  def test_LoadRecoveryFSTab(self):
+    fstab = '\n'.join([
+        '# comment',
+        '/dev/block/system /system ext4 ro,context=u:object_r:a:s0 wait',
+        '/dev/block/userdata /data f2fs nosuid wait,check,length=-16384',
+        '/dev/block/sdcard /sdcard vfat defaults voldmanaged=sdcard:auto',
+    ])
+    d = common.LoadRecoveryFSTab(
+        lambda _: fstab, 2, 'RECOVERY/RAMDISK/etc/recovery.fstab',
+        force_vendor=True)
+
+    self.assertEqual(['/data', '/system', '/vendor'], sorted(d.keys()))
+    self.assertEqual('/dev/block/system', d['/system'].device)
+    self.assertEqual('ext4', d['/system'].fs_type)
+    self.assertEqual(0, d['/system'].length)
+    self.assertEqual('context=u:object_r:a:s0', d['/system'].context)
+    self.assertEqual(-16384, d['/data'].length)
+    self.assertIsNone(d['/data'].context)
+    self.assertEqual('/dev/block/vendor', d['/vendor'].device)
+
+  def test_Cleanup(self):
+    temp_file = common.MakeTempFile()
+    temp_dir = common.MakeTempDir()
+    with open(os.path.join(temp_dir, 'file'), 'w') as f:
+      f.write('abc')
+    # Plain paths added by callers are still handled.
+    plain_dir = tempfile.mkdtemp()
+    common.OPTIONS.tempfiles.append(plain_dir)
+
+    common.Cleanup()
+    self.assertFalse(os.path.exists(temp_file))
+    self.assertFalse(os.path.exists(temp_dir))
+    self.assertFalse(os.path.exists(plain_dir))
+    self.assertEqual([], common.OPTIONS.tempfiles)
+
+  def test_PasswordManager_ReadFile(self):
+    pwfile = common.MakeTempFile()
+    with open(pwfile, 'w') as f:
+      f.write('# Enter key passwords between the [[[ ]]] brackets.\n'
+              '\n'
+              '[[[  foo  ]]] build/target/key1\n'
+              '  [[[bar baz]]]   build/target/key2  \n'
+              '[[[  ]]] build/target/key3\n'
+              'not a password line\n')
+    password_manager = common.PasswordManager()
+    password_manager.pwfile = pwfile
+    self.assertEqual(
+        {
+            'build/target/key1': 'foo',
+            'build/target/key2': 'bar baz',
+            'build/target/key3': '',
+        },
+        password_manager.ReadFile())
+
+  def test_ProbeDerPkcs8Key(self):
+    self.assertFalse(common._ProbeDerPkcs8Key(
+        os.path.join(self.testdata_dir, 'testkey.pk8')))
+    self.assertTrue(common._ProbeDerPkcs8Key(
+        os.path.join(self.testdata_dir, 'testkey_with_passwd.pk8')))
+
+  def test_ProbeDerPkcs8Key_unknownFormat(self):
+    self.assertIsNone(common._ProbeDerPkcs8Key(
+        os.path.join(self.testdata_dir, 'testkey.x509.pem')))
+    self.assertIsNone(common._ProbeDerPkcs8Key(
+        os.path.join(self.testdata_dir, 'nonexistent.pk8')))
+
   INFO_DICT_DEFAULT = {
       'recovery_api_version': 3,
       'fstab_version': 2,
@@ -1030,6 +1218,76 @@ class CommonUtilsTest(test_utils.ReleaseToolsTestCase):
       self.assertRaises(
           AssertionError, common.LoadInfoDict, target_files_zip, True)
 
+  def test_File_FromLocalFile_fileChangedLater(self):
+    path = common.MakeTempFile()
+    with open(path, 'wb') as f:
+      f.write(b'original')
+    local_file = common.File.FromLocalFile('foo', path)
+    with open(path, 'wb') as f:
+      f.write(b'changed, and longer')
+
+    self.assertEqual(b'original', local_file.data)
+    self.assertEqual(len(b'original'), local_file.size)
+    self.assertEqual(sha1(b'original').hexdigest(), local_file.sha1)
+
+    # The copy on disk no longer matches, so the diff tool gets 'data'.
+    diff = common.Difference(
+        local_file, common.File('source', b'source'),
+        diff_program=self._test_Difference_ComputePatch_createDiffProgram(0))
+    _, _, patch = diff.ComputePatch()
+    self.assertEqual(b'original', patch)
+
+  def test_File_WriteToDir_overSourceFile(self):
+    output_dir = common.MakeTempDir()
+    path = os.path.join(output_dir, 'foo')
+    with open(path, 'wb') as f:
+      f.write(b'data')
+    local_file = common.File.FromLocalFile('foo', path)
+
+    local_file.WriteToDir(output_dir)
+    with open(path, 'rb') as f:
+      self.assertEqual(b'data', f.read())
+
+  def test_Difference_ComputePatch_identicalFilesAllowEmpty(self):
+    data = os.urandom(4096)
+    # The diff program doesn't exist, so it fails the test if it gets run.
+    diff = common.Difference(
+        common.File('target', data), common.File('source', data),
+        diff_program='non-existent-diff')
+    _, _, patch = diff.ComputePatch(allow_empty=True)
+    self.assertEqual(b'', patch)
+
+  def test_Difference_ComputePatch_identicalFiles(self):
+    # Without allow_empty, the diff program still runs for identical files.
+    diff = common.Difference(
+        common.File('target', b'data'), common.File('source', b'data'),
+        diff_program=self._test_Difference_ComputePatch_createDiffProgram(0))
+    _, _, patch = diff.ComputePatch()
+    self.assertEqual(b'data', patch)
+
+  def _test_Difference_ComputePatch_createDiffProgram(self, exit_code):
+    # A fake diff program that complains on stderr, writes the target file as
+    # the patch and exits with the given code.
+    diff_program = common.MakeTempFile(suffix='.sh')
+    with open(diff_program, 'w') as f:
+      f.write('#!/bin/sh\necho "warning: fake diff" >&2\n'
+              'cp "$2" "$3"\nexit {}\n'.format(exit_code))
+    os.chmod(diff_program, 0o755)
+    return diff_program
+
+  def test_Difference_ComputePatch_diffProgramWritesStderr(self):
+    diff = common.Difference(
+        common.File('target', b'target'), common.File('source', b'source'),
+        diff_program=self._test_Difference_ComputePatch_createDiffProgram(0))
+    _, _, patch = diff.ComputePatch()
+    self.assertEqual(b'target', patch)
+
+  def test_Difference_ComputePatch_diffProgramFailsWithStderr(self):
+    diff = common.Difference(
+        common.File('target', b'target'), common.File('source', b'source'),
+        diff_program=self._test_Difference_ComputePatch_createDiffProgram(1))
+    self.assertEqual((None, None, None), diff.ComputePatch())
+
 
 class InstallRecoveryScriptFormatTest(test_utils.ReleaseToolsTestCase):
   """Checks the format of install-recovery.sh.
@@ -1091,6 +1349,33 @@ class InstallRecoveryScriptFormatTest(test_utils.ReleaseToolsTestCase):
     validate_target_files.ValidateInstallRecoveryScript(self._tempdir,
                                                         self._info)
 
+  def test_recovery_from_boot_identicalImages(self):
+    # A fake imgdiff that writes a non-empty patch, so that it's clear the
+    # diff has been run.
+    bin_dir = common.MakeTempDir()
+    imgdiff = os.path.join(bin_dir, 'imgdiff')
+    with open(imgdiff, 'w') as f:
+      f.write('#!/bin/sh\necho patch > "$3"\n')
+    os.chmod(imgdiff, 0o755)
+
+    recovery_image = common.File("recovery.img", self.boot_data)
+    boot_image = common.File("boot.img", self.boot_data)
+    path = os.environ['PATH']
+    os.environ['PATH'] = bin_dir + os.pathsep + path
+    try:
+      common.MakeRecoveryPatch(self._tempdir, self._out_tmp_sink,
+                               recovery_image, boot_image, self._info)
+    finally:
+      os.environ['PATH'] = path
+
+    system_dir = os.path.join(self._tempdir, 'SYSTEM')
+    self.assertFalse(
+        os.path.exists(os.path.join(system_dir, 'etc', 'recovery.img')))
+    with open(os.path.join(system_dir, 'recovery-from-boot.p'), 'rb') as f:
+      self.assertEqual(b'patch\n', f.read())
+    with open(os.path.join(system_dir, 'bin', 'install-recovery.sh')) as f:
+      self.assertIn('--patch /system/recovery-from-boot.p', f.read())
+
 
 class MockScriptWriter(object):
   """A class that mocks edify_generator.EdifyGenerator."""